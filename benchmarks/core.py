@@ -0,0 +1,49 @@
+import random
+from typing import Callable, Iterator, List, Tuple
+
+from mautrix.types.util.obj import Obj
+
+from donutbot.bot import SimpleMember, _format_donut, _format_members, _generate_donut
+from donutbot.donut import Donut, _donut_to_round
+from donutbot.history import PairingHistory
+from donutbot.shards import join_state, split_state
+from donutbot.store import _pack_data, _rounds_to_data, _state_to_rounds
+
+MEMBER_COUNTS = (10, 100, 1_000, 10_000, 100_000)
+GROUP_SIZES = (2, 3, 4, 5, 6)
+# Rounds in the history that gets saved to and loaded from room state
+HISTORY_ROUNDS = 5
+# The defaults of state_compression and state_max_event_bytes
+COMPRESS = True
+MAX_EVENT_BYTES = 60000
+
+def make_members(count: int) -> List[SimpleMember]:
+    return [SimpleMember(display_name=f"Member {i}", mxid=f"@member{i}:example.org") for i in range(count)]
+
+def cases(member_count: int, group_size: int, seed: int = 0) -> Iterator[Tuple[str, Callable[[], object]]]:
+    """(name, function) for every core function, set up for one room size.
+
+    Set-up work (members, donuts, state) happens here so only the call itself is measured.
+    """
+    random.seed(seed)
+    members = make_members(member_count)
+    # The grouping core works on interned ids; members[i] has id i
+    ids = list(range(member_count))
+    groups = _generate_donut(ids, group_size)
+    history = PairingHistory([_generate_donut(ids, group_size)])
+    donut = Donut({frozenset(members[i] for i in group) for group in groups})
+    rounds = [_donut_to_round(Donut({frozenset(members[i] for i in group)
+                                     for group in _generate_donut(ids, group_size)}))
+              for _ in range(HISTORY_ROUNDS)]
+    data = _rounds_to_data(rounds)
+    state = Obj(**_pack_data(data, COMPRESS))
+    manifest, shards = split_state(data, COMPRESS, MAX_EVENT_BYTES)
+    yield "_generate_donut", lambda: _generate_donut(ids, group_size)
+    yield "repeat_pairs", lambda: history.repeat_pairs(groups, len(history) - 1)
+    yield "_rounds_to_data", lambda: _rounds_to_data(rounds)
+    yield "_pack_data", lambda: _pack_data(data, COMPRESS)
+    yield "_state_to_rounds", lambda: _state_to_rounds(state)
+    yield "split_state", lambda: split_state(data, COMPRESS, MAX_EVENT_BYTES)
+    yield "join_state", lambda: join_state(manifest, shards)
+    yield "_format_donut", lambda: _format_donut(donut, "DONUT", html=True)
+    yield "_format_members", lambda: _format_members(members, "Members", html=True)
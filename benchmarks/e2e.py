@@ -0,0 +1,92 @@
+import asyncio
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Sequence
+
+from mautrix.util.async_db import Database
+from mautrix.util.config import RecursiveDict
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+
+from donutbot import db
+from donutbot.bot import Config, DonutBot
+
+from .core import make_members
+from .fake_client import FakeClient, FakeMessageEvent
+from .runner import Result
+
+BASE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "base-config.yaml")
+MEMBER_COUNTS = (10, 100, 1_000)
+GROUP_SIZES = (2, 4)
+# Let the bot go as fast as the fake server allows, and don't send progress messages
+CONFIG_OVERRIDES: Dict[str, Any] = {
+    "room_creation.rate": 200.0,
+    "room_creation.burst": 50,
+    "room_creation.progress_interval": 0,
+    # Off unless set with --set room_pool.size=N; filled before the commands are timed
+    "room_pool.size": 0,
+    "room_pool.quiet_hours": [0, 24],
+}
+
+class BenchmarkBot(DonutBot):
+    """DonutBot without maubot around it: the fake client, a temporary database and base-config.yaml."""
+
+    def __init__(self, client: FakeClient, database: Database, config: Config) -> None:
+        self.client = client # type: ignore
+        self.database = database
+        self.config = config
+        self.loop = asyncio.get_running_loop()
+        self.pool = None
+
+def load_config(overrides: Dict[str, Any]) -> Config:
+    yaml = YAML()
+    with open(BASE_CONFIG) as f:
+        base = RecursiveDict(yaml.load(f), CommentedMap)
+    def load() -> CommentedMap:
+        data = RecursiveDict(CommentedMap(), CommentedMap)
+        for key, value in overrides.items():
+            data[key] = value
+        return data._data
+    return Config(load=load, load_base=lambda: base, save=lambda _: None)
+
+async def run_room(database: Database, member_count: int, group_size: int,
+                   client_options: Dict[str, Any], overrides: Dict[str, Any]) -> List[Result]:
+    """Run `!donut new` and then `!donut confirm` in a fresh room of ``member_count`` members."""
+    client = FakeClient(**client_options)
+    room_id = client.add_room({m.mxid: m.display_name for m in make_members(member_count)})
+    bot = BenchmarkBot(client, database, load_config(overrides))
+    await bot.start()
+    results: List[Result] = []
+    try:
+        # Spare rooms from an earlier run belong to another fake server
+        await database.execute("DELETE FROM spare_room")
+        while await bot.fill_room_pool():
+            pass
+        for command in (f"!donut new {group_size}", "!donut confirm"):
+            evt = FakeMessageEvent(client, room_id, command)
+            client.reset_stats()
+            started = time.perf_counter()
+            await bot.base_command(evt)
+            seconds = time.perf_counter() - started
+            result = Result(f"e2e {command.split()[1]}", member_count, group_size, seconds, 0,
+                            {**client.stats(), "responses": len(evt.responses)})
+            results.append(result)
+    finally:
+        await bot.stop()
+    return results
+
+async def run(member_counts: Sequence[int], group_sizes: Sequence[int],
+              client_options: Dict[str, Any], overrides: Dict[str, Any]) -> List[Result]:
+    results: List[Result] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database.create(f"sqlite:///{tmp}/donutbot.db", upgrade_table=db.upgrade_table)
+        await database.start()
+        try:
+            for member_count in member_counts:
+                for group_size in group_sizes:
+                    results += await run_room(database, member_count, group_size, client_options,
+                                              {**CONFIG_OVERRIDES, **overrides})
+        finally:
+            await database.stop()
+    return results
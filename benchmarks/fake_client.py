@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from mautrix.errors.request import MatrixStandardRequestError, MForbidden, MLimitExceeded, MNotFound
+from mautrix.types import (EventType, Format, Member, Membership, MessageEventContent, MessageType,
+                           TextMessageEventContent)
+from mautrix.types.primitive import EventID, RoomID, UserID
+from mautrix.types.util.obj import Obj
+
+# Shared by all clients so room IDs never repeat within a process, like on a real server
+_ids = itertools.count(1)
+
+class FakeClient:
+    """An in-process stand-in for the homeserver client the bot talks to.
+
+    Only the calls DonutBot makes are implemented. Every call sleeps for
+    ``latency`` seconds (plus up to ``jitter`` more, or a per-call override from
+    ``latencies``), counts against a token bucket of ``rate`` calls per second
+    when ``rate`` is above 0, and fails with a 500 at ``failure_rate`` (or a
+    per-call rate from ``failure_rates``).
+    """
+
+    def __init__(self,
+                 mxid: str = "@donutbot:example.org",
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 latencies: Optional[Dict[str, float]] = None,
+                 rate: float = 0.0,
+                 burst: int = 10,
+                 failure_rate: float = 0.0,
+                 failure_rates: Optional[Dict[str, float]] = None,
+                 seed: Optional[int] = None) -> None:
+        self.mxid = UserID(mxid)
+        self.latency = latency
+        self.jitter = jitter
+        self.latencies = latencies or {}
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.failure_rate = failure_rate
+        self.failure_rates = failure_rates or {}
+        self.random = random.Random(seed)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        # Per-room joined members and state events keyed by (event type, state key)
+        self.members: Dict[RoomID, Dict[UserID, Member]] = {}
+        self.state: Dict[RoomID, Dict[Tuple[str, str], Dict[str, Any]]] = {}
+        self.messages: Dict[RoomID, List[Dict[str, Any]]] = {}
+        self.calls: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self.call_seconds: Counter = Counter()
+
+    def add_room(self, members: Dict[str, Optional[str]]) -> RoomID:
+        """Create a room the bot is already in, with ``members`` (mxid -> display name) joined."""
+        room_id = self._new_room_id()
+        joined = {UserID(mxid): Member(membership=Membership.JOIN, displayname=name)
+                  for mxid, name in members.items()}
+        joined[self.mxid] = Member(membership=Membership.JOIN, displayname="DONUT bot")
+        self.members[room_id] = joined
+        return room_id
+
+    def reset_stats(self) -> None:
+        for counter in (self.calls, self.failures, self.rate_limited, self.call_seconds):
+            counter.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": dict(self.calls),
+            "failures": dict(self.failures),
+            "rate_limited": dict(self.rate_limited),
+            "call_seconds": {k: round(v, 6) for k, v in self.call_seconds.items()},
+        }
+
+    #### The client API ####
+
+    async def get_joined_members(self, room_id: RoomID) -> Dict[UserID, Member]:
+        await self._request("get_joined_members")
+        members = self._room_members(room_id)
+        if self.mxid not in members:
+            raise MForbidden(403, "You aren't a member of the room")
+        return {user_id: member for user_id, member in members.items()
+                if member.membership == Membership.JOIN}
+
+    async def get_displayname(self, user_id: UserID) -> Optional[str]:
+        await self._request("get_displayname")
+        for members in self.members.values():
+            member = members.get(user_id)
+            if member and member.displayname:
+                return member.displayname
+        return None
+
+    async def get_state_event(self, room_id: RoomID, event_type: EventType, state_key: str = "") -> Obj:
+        await self._request("get_state_event")
+        if event_type == EventType.ROOM_MEMBER:
+            member = self._room_members(room_id).get(UserID(state_key))
+            if member is None:
+                raise MNotFound(404, "Event not found.")
+            return Obj(membership=str(member.membership), displayname=member.displayname)
+        content = self.state.get(room_id, {}).get((str(event_type), state_key))
+        if content is None:
+            raise MNotFound(404, "Event not found.")
+        # A copy, as if it had come over the wire
+        return Obj(**json.loads(json.dumps(content)))
+
+    async def send_state_event(self, room_id: RoomID, event_type: EventType, content: Any,
+                               state_key: str = "", **kwargs: Any) -> EventID:
+        await self._request("send_state_event")
+        self._room_members(room_id)
+        serialized = content.serialize() if hasattr(content, "serialize") else dict(content)
+        self.state.setdefault(room_id, {})[(str(event_type), state_key)] = serialized
+        return self._new_event_id()
+
+    async def create_room(self, name: Optional[str] = None, invitees: Optional[List[UserID]] = None,
+                          initial_state: Optional[List[Dict[str, Any]]] = None, **kwargs: Any) -> RoomID:
+        await self._request("create_room")
+        room_id = self._new_room_id()
+        self.members[room_id] = {self.mxid: Member(membership=Membership.JOIN)}
+        for user_id in invitees or []:
+            self.members[room_id][user_id] = Member(membership=Membership.INVITE)
+        self.state[room_id] = {(e["type"], e.get("state_key", "")): e["content"] for e in initial_state or []}
+        if name:
+            self.state[room_id][(str(EventType.ROOM_NAME), "")] = {"name": name}
+        return room_id
+
+    async def join_room(self, room_id: RoomID, **kwargs: Any) -> RoomID:
+        await self._request("join_room")
+        self._room_members(room_id)[self.mxid] = Member(membership=Membership.JOIN)
+        return room_id
+
+    async def invite_user(self, room_id: RoomID, user_id: UserID, **kwargs: Any) -> None:
+        await self._request("invite_user")
+        members = self._room_members(room_id)
+        if user_id in members and members[user_id].membership == Membership.JOIN:
+            raise MForbidden(403, f"{user_id} is already in the room")
+        members[user_id] = Member(membership=Membership.INVITE)
+
+    async def leave_room(self, room_id: RoomID, **kwargs: Any) -> None:
+        await self._request("leave_room")
+        self._room_members(room_id).pop(self.mxid, None)
+
+    async def send_message(self, room_id: RoomID, content: MessageEventContent, **kwargs: Any) -> EventID:
+        await self._request("send_message")
+        self.messages.setdefault(room_id, []).append(content.serialize())
+        return self._new_event_id()
+
+    async def send_text(self, room_id: RoomID, text: str, html: Optional[str] = None, **kwargs: Any) -> EventID:
+        content = TextMessageEventContent(msgtype=MessageType.TEXT, body=text)
+        if html:
+            content.format = Format.HTML
+            content.formatted_body = html
+        return await self.send_message(room_id, content)
+
+    #### Simulation ####
+
+    async def _request(self, name: str) -> None:
+        self.calls[name] += 1
+        started = time.monotonic()
+        try:
+            delay = self.latencies.get(name, self.latency)
+            if self.jitter:
+                delay += self.random.uniform(0, self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            retry_after = self._take_token()
+            if retry_after is not None:
+                self.rate_limited[name] += 1
+                e = MLimitExceeded(429, "Too Many Requests")
+                e.retry_after_ms = int(retry_after * 1000) + 1 # type: ignore
+                raise e
+            if self.random.random() < self.failure_rates.get(name, self.failure_rate):
+                self.failures[name] += 1
+                raise MatrixStandardRequestError(500, "Injected failure")
+        finally:
+            self.call_seconds[name] += time.monotonic() - started
+
+    def _take_token(self) -> Optional[float]:
+        if self.rate <= 0:
+            return None
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+    def _room_members(self, room_id: RoomID) -> Dict[UserID, Member]:
+        members = self.members.get(room_id)
+        if members is None:
+            raise MNotFound(404, "Unknown room")
+        return members
+
+    def _new_room_id(self) -> RoomID:
+        return RoomID(f"!room{next(_ids)}:example.org")
+
+    def _new_event_id(self) -> EventID:
+        return EventID(f"$event{next(_ids)}")
+
+class FakeMessageEvent:
+    """Just enough of maubot's MessageEvent for DonutBot's command handlers."""
+
+    def __init__(self, client: FakeClient, room_id: RoomID, body: str,
+                 sender: str = "@admin:example.org") -> None:
+        self.client = client
+        self.room_id = room_id
+        self.sender = UserID(sender)
+        self.event_id = client._new_event_id()
+        self.content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body)
+        self.responses: List[Dict[str, Any]] = []
+
+    async def respond(self, content: Any, **kwargs: Any) -> EventID:
+        if isinstance(content, str):
+            content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=content)
+        self.responses.append(content.serialize())
+        return await self.client.send_message(self.room_id, content)
+
+    async def reply(self, content: Any, **kwargs: Any) -> EventID:
+        return await self.respond(content, **kwargs)
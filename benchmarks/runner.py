@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from . import core
+
+class Result(NamedTuple):
+    name: str
+    members: int
+    group_size: int
+    # Best of all repeats, in seconds
+    seconds: float
+    # Peak traced allocation during one extra call, in bytes (0 when not traced)
+    peak_bytes: int
+    # Anything else the suite reports, like homeserver call counts
+    extra: Optional[Dict[str, Any]] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}[members={self.members},group_size={self.group_size}]"
+
+def measure(fn: Callable[[], object], repeat: int) -> Tuple[float, int]:
+    """Time ``fn`` ``repeat`` times and keep the best, then trace one more call for memory.
+
+    Tracing slows allocation down a lot, so it's kept out of the timed calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def repeats_for(member_count: int, repeat: int) -> int:
+    # The biggest rooms take seconds per call, a few runs are enough there
+    return max(1, repeat if member_count <= 10_000 else repeat // 5)
+
+def run_core(member_counts: Sequence[int], group_sizes: Sequence[int], repeat: int,
+             only: Optional[Sequence[str]] = None) -> List[Result]:
+    results: List[Result] = []
+    for member_count in member_counts:
+        for group_size in group_sizes:
+            for name, fn in core.cases(member_count, group_size):
+                if only and name not in only:
+                    continue
+                seconds, peak = measure(fn, repeats_for(member_count, repeat))
+                result = Result(name, member_count, group_size, seconds, peak)
+                print(f"{result.key:<60} {seconds * 1000:>12.3f} ms {peak / 1024:>12.1f} KiB", file=sys.stderr)
+                results.append(result)
+    return results
+
+def metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+def write_results(path: str, results: List[Result]) -> None:
+    data = {
+        "metadata": metadata(),
+        "results": [{**r._asdict(), "key": r.key} for r in results],
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+def compare(baseline_path: str, results: List[Result], threshold: float) -> List[str]:
+    """Keys of results that got ``threshold`` times slower or bigger than the baseline."""
+    with open(baseline_path) as f:
+        baseline = {r["key"]: r for r in json.load(f)["results"]}
+    regressions: List[str] = []
+    for r in results:
+        old = baseline.get(r.key)
+        if old is None or old["seconds"] <= 0:
+            continue
+        ratio = r.seconds / old["seconds"]
+        memory_ratio = r.peak_bytes / old["peak_bytes"] if old["peak_bytes"] else 1.0
+        marker = ""
+        if ratio > threshold or memory_ratio > threshold:
+            regressions.append(r.key)
+            marker = "  REGRESSION"
+        print(f"{r.key:<60} time x{ratio:.2f}  memory x{memory_ratio:.2f}{marker}", file=sys.stderr)
+    return regressions
+
+def _int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(",") if x]
+
+def _setting(s: str) -> Tuple[str, Any]:
+    key, _, value = s.partition("=")
+    return key, json.loads(value) if value else None
+
+def _per_call(s: str) -> Dict[str, float]:
+    name, _, value = s.partition("=")
+    return {name: float(value)}
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmark the donutbot core functions, or with --suite e2e "
+                                                 "the new and confirm commands against a fake homeserver")
+    parser.add_argument("--suite", choices=("core", "e2e"), default="core",
+                        help="what to benchmark (default: %(default)s)")
+    parser.add_argument("--members", type=_int_list,
+                        help="comma-separated member counts (default depends on --suite)")
+    parser.add_argument("--group-sizes", type=_int_list,
+                        help="comma-separated group sizes (default depends on --suite)")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="timed calls per case, the best one counts (default: %(default)s)")
+    parser.add_argument("--only", action="append",
+                        help="only run this function, can be given more than once")
+    parser.add_argument("--output", "-o", default="bench_output.json",
+                        help="where to write the JSON results (default: %(default)s)")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="with --compare, fail when a case is this many times slower "
+                             "or bigger (default: %(default)s)")
+    e2e_options = parser.add_argument_group("e2e options")
+    e2e_options.add_argument("--latency", type=float, default=0.02,
+                             help="seconds every homeserver call takes (default: %(default)s)")
+    e2e_options.add_argument("--call-latency", type=_per_call, action="append", metavar="CALL=SECONDS",
+                             help="latency for one call instead of --latency, e.g. create_room=0.5")
+    e2e_options.add_argument("--jitter", type=float, default=0.01,
+                             help="up to this many extra seconds per call (default: %(default)s)")
+    e2e_options.add_argument("--server-rate", type=float, default=0,
+                             help="calls per second before the homeserver answers 429, "
+                                  "0 for no limit (default: %(default)s)")
+    e2e_options.add_argument("--server-burst", type=int, default=10,
+                             help="calls the homeserver allows in a burst (default: %(default)s)")
+    e2e_options.add_argument("--failure-rate", type=float, default=0,
+                             help="fraction of calls that fail with a 500 (default: %(default)s)")
+    e2e_options.add_argument("--fail", type=_per_call, action="append", metavar="CALL=RATE",
+                             help="failure rate for one call, e.g. create_room=0.1")
+    e2e_options.add_argument("--set", type=_setting, action="append", metavar="KEY=JSON",
+                             help="override a bot config value, e.g. room_creation.concurrency=16")
+    args = parser.parse_args(argv)
+
+    if args.suite == "e2e":
+        # Only the e2e suite needs a database driver
+        from . import e2e
+        client_options = {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "latencies": {k: v for latencies in args.call_latency or [] for k, v in latencies.items()},
+            "rate": args.server_rate,
+            "burst": args.server_burst,
+            "failure_rate": args.failure_rate,
+            "failure_rates": {k: v for rates in args.fail or [] for k, v in rates.items()},
+            "seed": 0,
+        }
+        results = asyncio.run(e2e.run(args.members or e2e.MEMBER_COUNTS, args.group_sizes or e2e.GROUP_SIZES,
+                                      client_options, dict(args.set or [])))
+        for r in results:
+            calls = sum((r.extra or {}).get("calls", {}).values())
+            print(f"{r.key:<60} {r.seconds * 1000:>12.3f} ms {calls:>8} calls", file=sys.stderr)
+    else:
+        results = run_core(args.members or core.MEMBER_COUNTS, args.group_sizes or core.GROUP_SIZES,
+                           args.repeat, args.only)
+    write_results(args.output, results)
+    print(f"Wrote {len(results)} results to {args.output}", file=sys.stderr)
+    if args.compare:
+        regressions = compare(args.compare, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.compare}", file=sys.stderr)
+            sys.exit(1)
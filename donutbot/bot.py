@@ -1,35 +1,89 @@
 import asyncio
+import json
+import math
+import multiprocessing
 import random
-from attr import dataclass
-from datetime import date
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, tzinfo
 from logging import warn, info
-from math import floor
-from typing import Dict, FrozenSet, Iterable, List, NamedTuple, NewType, Optional, Set, Union, Any, Tuple
+from typing import (Awaitable, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional,
+                    Sequence, Set, Type, Union, Any, Tuple)
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from maubot import MessageEvent, Plugin
-from maubot.handlers import command
-from mautrix.errors.request import MNotFound
+from maubot.handlers import command, event, web
+from aiohttp.web import Request, Response
+from mautrix.errors.request import MatrixRequestError, MForbidden, MNotFound
+from mautrix.types import (Format, MessageEventContent, MessageType, RoomNameStateEventContent,
+                           TextMessageEventContent)
 from mautrix.types.event.encrypted import EncryptionAlgorithm
 from mautrix.types.event.type import EventType
-from mautrix.types.primitive import RoomID, UserID
-from mautrix.types.users import Member
-from mautrix.types.event.state import RoomEncryptionStateEventContent, StateEventContent
-from mautrix.types.util.serializable_attrs import SerializableAttrs
-from mautrix.types.util.obj import Obj, Lst
+from mautrix.types.primitive import EventID, RoomID, UserID
+from mautrix.types.event.state import (Membership, MemberStateEventContent, RoomEncryptionStateEventContent,
+                                       StateEvent)
+from mautrix.util import markdown
+from mautrix.util.async_db import UpgradeTable
+from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
-class SimpleMember(NamedTuple):
-    display_name: str
-    mxid: str
+from . import db, formatting, vectorized
+from .cache import LRUCache
+from .donut import Donut, Round, SimpleMember, _donut_to_round
+from .grouping import RepairedGroup, assign_groups, group_sizes, repair_groups
+from .history import PairingHistory
+from .interning import Group, MemberTable, id_pair
+from .metrics import InstrumentedClient, Metrics, timed
+from .ratelimit import ProgressCallback, RateLimiter, run_bounded
+from .schedule import Schedule, localize, to_ms
+from .store import (DatabaseDonutStore, DonutStore, MemoryDonutStore, StateEventDonutStore,
+                    donut_state_event)
 
-Donut = NewType("Donut", Set[FrozenSet[SimpleMember]])
+# Sends a reply to wherever a round was started from, like MessageEvent.respond
+Responder = Callable[[Union[str, MessageEventContent]], Awaitable[Any]]
 
-donut_state_event = EventType.find("net.hyperflux.donutbot.donut_state",
-                                        t_class=EventType.Class.STATE)
+class ParsedDonutState(NamedTuple):
+    # Interned with the room's MemberTable
+    current_groups: Optional[List[Group]]
+    last_groups: Optional[List[Group]]
+    history: PairingHistory
 
-@dataclass
-class DonutStateEventContent(SerializableAttrs):
-    last_donut: Donut
-    current_donut: Donut
+class Config(BaseProxyConfig):
+    def do_update(self, helper: ConfigUpdateHelper) -> None:
+        helper.copy("avoid_repeat_rounds")
+        helper.copy("grouping_time_budget")
+        helper.copy("grouping_mode")
+        helper.copy("grouping_candidates")
+        helper.copy("vectorized_max_members")
+        helper.copy("offload_min_members")
+        helper.copy("offload_workers")
+        helper.copy("message_format")
+        helper.copy("message_max_bytes")
+        helper.copy("storage")
+        helper.copy("state_compression")
+        helper.copy("state_max_event_bytes")
+        helper.copy("proposal_ttl")
+        helper.copy("proposal_cache_members")
+        helper.copy("name_cache_size")
+        helper.copy("name_cache_ttl")
+        helper.copy("room_creation.concurrency")
+        helper.copy("room_creation.rate")
+        helper.copy("room_creation.burst")
+        helper.copy("room_creation.max_retries")
+        helper.copy("room_creation.progress_interval")
+        helper.copy("schedule.timezone")
+        helper.copy("schedule.tick")
+        helper.copy("schedule.jitter")
+        helper.copy("schedule.concurrency")
+        helper.copy("schedule.batch")
+        helper.copy("schedule.missed_grace")
+        helper.copy("donut_rooms.reuse")
+        helper.copy("donut_rooms.keep_days")
+        helper.copy("donut_rooms.leave_concurrency")
+        helper.copy("donut_rooms.leave_batch")
+        helper.copy("room_pool.size")
+        helper.copy("room_pool.batch")
+        helper.copy("room_pool.quiet_hours")
 
 def _str_to_int(s: str) -> Union[int, None]:
     try:
@@ -38,81 +92,741 @@ def _str_to_int(s: str) -> Union[int, None]:
         return None
 
 class DonutBot(Plugin):
-    proposed_donuts: Dict[RoomID, Donut] = dict()
+    # Proposals are kept in the database; this holds the recently used ones, interned
+    proposed_donuts: LRUCache[RoomID, List[Group]]
+    # Per-room mxid <-> id tables. Ids never change, so these are only ever added to.
+    member_tables: Dict[RoomID, MemberTable]
+    # Per-room joined members, loaded once and kept current from m.room.member events
+    rosters: Dict[RoomID, Set[UserID]]
+    # Display names by room and mxid, fed by the same events. Nothing else stores
+    # names; they're only looked up when something is shown.
+    display_names: LRUCache[Tuple[RoomID, str], str]
+    # Per-room decoded donut state, so it's only parsed once per change
+    parsed_states: Dict[RoomID, ParsedDonutState]
+    # Rooms whose donut state was changed by someone else, so the store has to
+    # re-import them from Matrix state
+    stale_rooms: Set[RoomID]
+    # The room state is the source of truth; store is where history is read from
+    state_store: StateEventDonutStore
+    store: DonutStore
+    limiter: RateLimiter
+    metrics: Metrics
+    # self.client, with every homeserver call timed for the metrics
+    api: InstrumentedClient
+    # Process pool for grouping big rooms, created on first use
+    pool: Optional[ProcessPoolExecutor] = None
+    scheduler: Optional["asyncio.Task[None]"] = None
+
+    @classmethod
+    def get_config_class(cls) -> Type[BaseProxyConfig]:
+        return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return db.upgrade_table
+
+    async def start(self) -> None:
+        self.config.load_and_update()
+        self.metrics = Metrics()
+        self.api = InstrumentedClient(self.client, self.metrics)
+        self.limiter = self._make_limiter()
+        self.state_store = StateEventDonutStore(self.api, self.limiter, # type: ignore
+                                                compress=self.config["state_compression"],
+                                                max_event_bytes=self.config["state_max_event_bytes"],
+                                                concurrency=self.config["room_creation.concurrency"])
+        self.store = self._make_store()
+        self.proposed_donuts = LRUCache(max_size=self.config["proposal_cache_members"],
+                                        ttl=self.config["proposal_ttl"],
+                                        size_of=lambda d: sum(len(group) for group in d))
+        self.display_names = LRUCache(max_size=self.config["name_cache_size"], ttl=self.config["name_cache_ttl"])
+        self.member_tables = dict()
+        self.rosters = dict()
+        self.parsed_states = dict()
+        self.stale_rooms = set()
+        await db.delete_expired_proposals(self.database, _now_ms() - self.config["proposal_ttl"] * 1000)
+        if self.config["grouping_mode"] == "vectorized" and not vectorized.available():
+            warn("grouping_mode is vectorized but numpy isn't installed, using search instead")
+        self.scheduler = asyncio.create_task(self.run_scheduler())
+
+    async def stop(self) -> None:
+        if self.scheduler:
+            self.scheduler.cancel()
+            self.scheduler = None
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def on_external_config_update(self) -> None:
+        self.config.load_and_update()
+        self.limiter = self._make_limiter()
+        self.state_store.limiter = self.limiter
+        self.state_store.compress = self.config["state_compression"]
+        self.state_store.max_event_bytes = self.config["state_max_event_bytes"]
+        self.state_store.concurrency = self.config["room_creation.concurrency"]
+        self.store = self._make_store()
+        self.parsed_states.clear()
+        self.proposed_donuts.max_size = self.config["proposal_cache_members"]
+        self.proposed_donuts.ttl = self.config["proposal_ttl"]
+        self.display_names.max_size = self.config["name_cache_size"]
+        self.display_names.ttl = self.config["name_cache_ttl"]
+
+    def _make_limiter(self) -> RateLimiter:
+        return RateLimiter(rate=self.config["room_creation.rate"],
+                           burst=self.config["room_creation.burst"],
+                           max_retries=self.config["room_creation.max_retries"],
+                           on_retry=self.metrics.retries.inc)
+
+    def _make_store(self) -> DonutStore:
+        storage = self.config["storage"]
+        if storage == "memory":
+            return MemoryDonutStore()
+        if storage == "state":
+            return self.state_store
+        if storage != "database":
+            warn(f"Unknown storage {storage}, using database instead")
+        return DatabaseDonutStore(self.database)
 
     #### Getting and setting Matrix room state ####
 
-    async def get_members(self, evt: MessageEvent) -> List[SimpleMember]:
-        room_id = evt.room_id
-        new_members = (await evt.client.get_joined_members(room_id)).items()
-        def item_to_simple_member(i: Tuple[UserID, Member]) -> SimpleMember:
-            return SimpleMember(display_name=i[1].displayname, mxid=i[0]) # type: ignore
-        simple_members = [item_to_simple_member(i) for i in new_members if i[0] != evt.client.mxid]
-        return simple_members
+    async def get_members(self, room_id: RoomID) -> List[SimpleMember]:
+        roster = self.rosters.get(room_id)
+        if roster is None:
+            roster = await self.load_roster(room_id)
+        return [SimpleMember(display_name=None, mxid=mxid) for mxid in roster if mxid != self.client.mxid]
 
-    async def get_donut_state(self, room_id: RoomID) -> Union[StateEventContent, None]:
-        try:
-            return await self.client.get_state_event(room_id, donut_state_event)
-        except MNotFound:
-            return None
+    async def load_roster(self, room_id: RoomID) -> Set[UserID]:
+        joined = await self.api.get_joined_members(room_id)
+        for user_id, member in joined.items():
+            self.cache_display_name(room_id, user_id, member.displayname, in_roster=True)
+        roster = set(joined)
+        self.rosters[room_id] = roster
+        return roster
+
+    def cache_display_name(self, room_id: RoomID, mxid: str, name: Optional[str], in_roster: bool) -> None:
+        # An empty string caches that there's no name, since the cache can't hold None.
+        # Member events keep the names of roster members current, so those don't expire.
+        self.display_names.put((room_id, mxid), name or "", expires_at=math.inf if in_roster else None)
+
+    async def get_display_names(self, room_id: RoomID, mxids: Iterable[str]) -> Dict[str, Optional[str]]:
+        """The display name in ``room_id`` of each of ``mxids``, or None if they have none.
+
+        Names come from the cache where possible. Misses are looked up one by one,
+        from the member event of those still in the room and from the profile of
+        those who aren't.
+        """
+        names: Dict[str, Optional[str]] = dict()
+        def from_cache(wanted: Iterable[str]) -> List[str]:
+            missing: List[str] = list()
+            for mxid in wanted:
+                name = self.display_names.get((room_id, mxid))
+                if name is None:
+                    missing.append(mxid)
+                else:
+                    names[mxid] = name or None
+            return missing
+        missing = from_cache(mxids)
+        roster = self.rosters.get(room_id)
+        if missing and roster is None:
+            # Nothing is known about the room yet, and its member list fills the cache
+            roster = await self.load_roster(room_id)
+            missing = from_cache(missing)
+        async def fetch(mxid: str) -> None:
+            in_roster = roster is not None and UserID(mxid) in roster
+            try:
+                if in_roster:
+                    member = await self.limiter.call(self.api.get_state_event, room_id,
+                                                     EventType.ROOM_MEMBER, mxid)
+                    name = member.displayname
+                else:
+                    name = await self.limiter.call(self.api.get_displayname, UserID(mxid))
+            except MatrixRequestError:
+                in_roster = False
+                name = None
+            self.cache_display_name(room_id, mxid, name, in_roster)
+            names[mxid] = name
+        await run_bounded(missing, fetch, concurrency=self.config["room_creation.concurrency"])
+        return names
+
+    async def with_names(self, room_id: RoomID, members: Iterable[SimpleMember]) -> List[SimpleMember]:
+        members = list(members)
+        names = await self.get_display_names(room_id, {m.mxid for m in members})
+        return [SimpleMember(display_name=names.get(m.mxid), mxid=m.mxid) for m in members]
+
+    @event.on(EventType.ROOM_MEMBER)
+    async def handle_member(self, evt: StateEvent) -> None:
+        if evt.state_key == self.client.mxid and evt.content.membership != Membership.JOIN:
+            # We're no longer in the room, so the roster and names can't be kept current
+            self.rosters.pop(evt.room_id, None)
+            for key in [key for key in self.display_names.entries if key[0] == evt.room_id]:
+                self.display_names.pop(key)
+            # If it was a DONUT room, a repeat group can't go back to it any more
+            await db.delete_donut_rooms(self.database, [evt.room_id])
+            await db.delete_spare_room(self.database, evt.room_id)
+            return
+        user_id = UserID(evt.state_key)
+        content: MemberStateEventContent = evt.content # type: ignore
+        roster = self.rosters.get(evt.room_id)
+        if roster is None:
+            # Not loaded yet (or not a room we run DONUTs in); the first command
+            # will fetch the full member list and names with it
+            return
+        if content.membership == Membership.JOIN:
+            roster.add(user_id)
+            # Covers both new joins and display name changes
+            self.cache_display_name(evt.room_id, user_id, content.displayname, in_roster=True)
+        else:
+            roster.discard(user_id)
+            # Nothing keeps their name current any more, so it's looked up again later
+            self.display_names.pop((evt.room_id, user_id))
+
+    async def get_parsed_state(self, room_id: RoomID) -> ParsedDonutState:
+        parsed = self.parsed_states.get(room_id)
+        if parsed is None:
+            imported = self.store is self.state_store or room_id in self.stale_rooms
+            rounds = None if imported else (await self.store.load([room_id]))[room_id]
+            if not rounds:
+                # Nothing stored yet (or it's out of date), so import from Matrix
+                rounds = (await self.state_store.load([room_id]))[room_id]
+                if self.store is not self.state_store:
+                    await self.store.replace({room_id: rounds})
+                self.stale_rooms.discard(room_id)
+            parsed = _rounds_to_parsed_state(rounds, self.member_table(room_id))
+            self.parsed_states[room_id] = parsed
+        return parsed
+
+    def member_table(self, room_id: RoomID) -> MemberTable:
+        table = self.member_tables.get(room_id)
+        if table is None:
+            table = self.member_tables[room_id] = MemberTable()
+        return table
 
     async def get_last_donut(self, room_id: RoomID) -> Optional[Donut]:
-        donut_state = await self.get_donut_state(room_id)
-        if (donut_state and isinstance(donut_state, Obj)):
-            last_donut = donut_state.get("last_donut")
-            if last_donut:
-                return _json_to_donut(last_donut)
-        return None
+        groups = (await self.get_parsed_state(room_id)).last_groups
+        return self.member_table(room_id).to_donut(groups) if groups else None
 
     async def get_current_donut(self, room_id: RoomID) -> Optional[Donut]:
-        donut_state = await self.get_donut_state(room_id)
-        if (donut_state and isinstance(donut_state, Obj)):
-            current_donut = donut_state.get("current_donut")
-            if current_donut:
-                return _json_to_donut(current_donut)
-        return None
+        groups = (await self.get_parsed_state(room_id)).current_groups
+        return self.member_table(room_id).to_donut(groups) if groups else None
+
+    async def get_history(self, room_id: RoomID) -> PairingHistory:
+        return (await self.get_parsed_state(room_id)).history
 
     async def set_current_donut(self, donut: Donut, room_id: RoomID):
-        donut_state = await self.get_donut_state(room_id)
-        if not donut_state:
-            donut_state = Obj()
-        old_donut = await self.get_current_donut(room_id)
-        if old_donut:
-            donut_state["last_donut"] = _donut_to_json(old_donut)
-        donut_state["current_donut"] = _donut_to_json(donut)
-        await self.client.send_state_event(room_id=room_id, 
-                                           event_type=donut_state_event, 
-                                           content=donut_state)
-
-    async def invite_users_to_donut(self, donut: Donut):
-        await asyncio.gather(*(self.create_donut_room(group) for group in donut))
-
-    async def create_donut_room(self, group: Iterable[SimpleMember]):
+        """Save the proposed ``donut`` as the newest round, in room state and then the store.
+
+        When room state is written, that's noted on the proposal. If the store
+        fails after that, a retry only writes the store, with the same time, so
+        the round isn't added to room state twice.
+        """
+        parsed = await self.get_parsed_state(room_id)
+        new_round = _donut_to_round(donut)
+        groups = self.member_table(room_id).from_donut(donut)
+        saved_at = await db.get_proposal_saved_at(self.database, room_id)
+        if saved_at is None:
+            saved_at = _now_ms()
+            await self.state_store.append({room_id: new_round}, saved_at)
+            await db.mark_proposal_saved(self.database, room_id, saved_at)
+        elif {frozenset(g) for g in parsed.current_groups or ()} == {frozenset(g) for g in groups}:
+            # The store had nothing, so loading it imported this round from room state
+            await db.delete_repair_setup(self.database, room_id)
+            return
+        if self.store is not self.state_store:
+            await self.store.append({room_id: new_round}, saved_at)
+        parsed.history.add_round(groups)
+        self.parsed_states[room_id] = ParsedDonutState(current_groups=groups,
+                                                       last_groups=parsed.current_groups,
+                                                       history=parsed.history)
+        # A half-done repair was for the round before
+        await db.delete_repair_setup(self.database, room_id)
+
+    async def replace_current_donut(self, donut: Donut, room_id: RoomID) -> None:
+        new_round = _donut_to_round(donut)
+        await self.state_store.replace_latest({room_id: new_round})
+        if self.store is not self.state_store:
+            await self.store.replace_latest({room_id: new_round})
+        # The pair index can't take a round back out, so it's rebuilt on next use
+        self.parsed_states.pop(room_id, None)
+
+    @event.on(donut_state_event)
+    async def handle_donut_state(self, evt: StateEvent) -> None:
+        if self.state_store.is_own_echo(evt):
+            # The echo of something we wrote ourselves
+            return
+        # Someone else changed the donut state; re-read it on next use
+        self.state_store.invalidate(evt.room_id)
+        self.parsed_states.pop(evt.room_id, None)
+        self.stale_rooms.add(evt.room_id)
+
+    async def invite_users_to_donut(self, room_id: RoomID, donut: Donut,
+                                    on_progress: Optional[ProgressCallback] = None) -> int:
+        """Set up a room for every group, picking up where an earlier attempt stopped.
+
+        Each finished step is written to the setup journal, so groups that are done
+        are skipped and half-done ones only get their missing steps. Returns how
+        many groups were already done before this call.
+        """
+        setup = await db.get_setup(self.database, room_id)
+        old_rooms = await db.get_donut_rooms(self.database, room_id) if self.config["donut_rooms.reuse"] else {}
+        groups = [g for g in donut if setup.get(_group_key(g), _NOT_STARTED).step < db.SETUP_WELCOMED]
+        already_done = len(donut) - len(groups)
+        async def report(done: int, total: int) -> None:
+            if on_progress:
+                await on_progress(already_done + done, already_done + total)
+        async def set_up(group: FrozenSet[SimpleMember]) -> None:
+            key = _group_key(group)
+            await self.create_donut_room(room_id, group, setup.get(key, _NOT_STARTED), old_rooms.get(key))
+        errors = await run_bounded(groups, set_up,
+                                   concurrency=self.config["room_creation.concurrency"],
+                                   on_progress=report)
+        failed = [(g, e) for g, e in zip(groups, errors) if e is not None]
+        self.metrics.rooms_created.inc(amount=len(groups) - len(failed))
+        self.metrics.room_failures.inc(amount=len(failed))
+        for group, e in failed:
+            warn(f"Error creating DONUT room for {[m.mxid for m in group]}: {e}")
+        if failed:
+            raise Exception(f"{len(failed)} of {len(donut)} DONUT rooms could not be created "
+                            f"(first error: {failed[0][1]}). Confirm again to retry just those")
+        return already_done
+
+    async def create_donut_room(self, room_id: RoomID, group: Iterable[SimpleMember],
+                                setup: Optional[db.SetupStep] = None, old_room_id: Optional[RoomID] = None,
+                                journal_key: Optional[str] = None):
+        """Set up a room for ``group``, going back to ``old_room_id`` if the group met there before.
+
+        Progress goes to the journal under ``journal_key``, the group's key unless given.
+        """
+        group_key = _group_key(group)
+        journal_key = journal_key or group_key
         invitees = [UserID(m.mxid) for m in group]
-        room_name = "DONUT! {}".format(date.today().strftime("%B %d, %Y"))
-        initial_state: List[Dict[str, Any]] = [{
-            "content": {"history_visibility": "invited"}, 
-            "type": "m.room.history_visibility",
-            "state_key": "",
-        }]
-        new_room_id = await self.client.create_room(
-            name=room_name, 
-            invitees=invitees, 
-            initial_state=initial_state, # type: ignore
-        )
-        # Ensure the bot is in the room
-        await self.client.join_room(new_room_id)
-        await self.client.send_text(
-            new_room_id,
-            "Welcome to DONUT! Please use this room to coordinate a friendly chat and "
-            "the consumption of doughnuts!!!",
-        )
+        new_room_id = setup.donut_room_id if setup else None
+        if new_room_id is not None and not await self.reopen_donut_room(new_room_id, invitees):
+            # An earlier try may have stopped before everyone was invited, and
+            # if the room can't be used any more, this one starts over
+            new_room_id = None
+        if new_room_id is None and old_room_id and await self.reopen_donut_room(old_room_id, invitees):
+            new_room_id = old_room_id
+            await db.record_setup(self.database, room_id, journal_key, db.SETUP_CREATED, new_room_id)
+            self.metrics.rooms_reused.inc()
+        if new_room_id is None:
+            room_name = "DONUT! {}".format(date.today().strftime("%B %d, %Y"))
+            new_room_id = await self.take_spare_room(room_id, journal_key, room_name, invitees)
+            if new_room_id is None:
+                # Encryption and history visibility are set up by create_room itself, and the
+                # creator is joined automatically, so the welcome text is the only follow-up
+                new_room_id = await self.limiter.call(
+                    self.api.create_room,
+                    name=room_name, 
+                    invitees=invitees, 
+                    initial_state=_donut_room_state(), # type: ignore
+                )
+                await db.record_setup(self.database, room_id, journal_key, db.SETUP_CREATED, new_room_id)
+        if new_room_id == old_room_id:
+            welcome = ("Welcome back to DONUT! You've been grouped together again, so here's another "
+                       "round of friendly chat and doughnuts!!!")
+        else:
+            welcome = ("Welcome to DONUT! Please use this room to coordinate a friendly chat and "
+                       "the consumption of doughnuts!!!")
+        await self.limiter.call(self.api.send_text, new_room_id, welcome)
+        await db.record_setup(self.database, room_id, journal_key, db.SETUP_WELCOMED, new_room_id)
+        await db.put_donut_room(self.database, room_id, group_key, new_room_id, _now_ms())
         info(f"Users {invitees} invited to room {new_room_id}")
-        await self.client.send_state_event(
-            new_room_id,
-            EventType.ROOM_ENCRYPTION,
-            RoomEncryptionStateEventContent(EncryptionAlgorithm.MEGOLM_V1),
-        )
+
+    async def take_spare_room(self, room_id: RoomID, journal_key: str, name: str,
+                              invitees: List[UserID]) -> Optional[RoomID]:
+        """A room from the pool, renamed to ``name`` and with ``invitees`` invited.
+
+        The room goes to the setup journal under ``journal_key`` as soon as it's
+        taken, so a retry after a crash picks it up again. None if the pool is
+        empty, so the caller has to create a room after all.
+        """
+        donut_room_id = await db.take_spare_room(self.database, room_id, journal_key)
+        if donut_room_id is None:
+            return None
+        self.metrics.spare_rooms_used.inc()
+        try:
+            await self.limiter.call(self.api.send_state_event, donut_room_id, EventType.ROOM_NAME,
+                                    RoomNameStateEventContent(name=name))
+        except MatrixRequestError as e:
+            # Only cosmetic; the group can still meet there
+            warn(f"Couldn't rename spare room {donut_room_id}: {e}")
+        # The room is in the journal, so if this fails a retry only invites whoever is missing
+        await self.invite_all(donut_room_id, invitees)
+        return donut_room_id
+
+    async def invite_all(self, donut_room_id: RoomID, invitees: List[UserID]) -> None:
+        """Invite all of ``invitees`` at once, going on past the ones that fail.
+
+        Being refused (say, they're banned) is only logged, since trying again
+        won't change it. Other errors are raised once everyone was tried.
+        """
+        async def invite(user_id: UserID) -> None:
+            await self.limiter.call(self.api.invite_user, donut_room_id, user_id)
+        errors = await run_bounded(invitees, invite, concurrency=len(invitees))
+        for user_id, e in zip(invitees, errors):
+            if e is not None:
+                warn(f"Couldn't invite {user_id} to DONUT room {donut_room_id}: {e}")
+        retry = [e for e in errors if e is not None and not isinstance(e, MForbidden)]
+        if retry:
+            raise Exception(f"{len(retry)} of {len(invitees)} couldn't be invited to DONUT room "
+                            f"{donut_room_id} (first error: {retry[0]})")
+
+    async def fill_room_pool(self) -> int:
+        """Create empty rooms until the pool has ``room_pool.size`` of them.
+
+        Only during ``room_pool.quiet_hours``, and at most ``room_pool.batch`` per
+        call, one after the other. Returns how many were created.
+        """
+        missing = self.config["room_pool.size"] - await db.count_spare_rooms(self.database)
+        if missing <= 0 or not self._in_quiet_hours():
+            return 0
+        created = 0
+        for _ in range(min(missing, self.config["room_pool.batch"])):
+            donut_room_id = await self.limiter.call(
+                self.api.create_room,
+                name="DONUT!",
+                initial_state=_donut_room_state(), # type: ignore
+            )
+            await db.add_spare_room(self.database, donut_room_id, _now_ms())
+            self.metrics.spare_rooms_created.inc()
+            created += 1
+        info(f"Added {created} rooms to the DONUT room pool")
+        return created
+
+    def _in_quiet_hours(self) -> bool:
+        start, end = self.config["room_pool.quiet_hours"]
+        hour = localize(_now_ms(), self._timezone()).hour
+        if start <= end:
+            return start <= hour < end
+        # Past midnight, like [22, 6]
+        return hour >= start or hour < end
+
+    async def reopen_donut_room(self, donut_room_id: RoomID, invitees: List[UserID]) -> bool:
+        """Invite whoever of ``invitees`` isn't in a DONUT room. False if the room can't be used any more."""
+        try:
+            joined = await self.limiter.call(self.api.get_joined_members, donut_room_id)
+        except (MForbidden, MNotFound) as e:
+            info(f"Not reusing DONUT room {donut_room_id}: {e}")
+            await db.delete_donut_rooms(self.database, [donut_room_id])
+            return False
+        if self.client.mxid not in joined:
+            await db.delete_donut_rooms(self.database, [donut_room_id])
+            return False
+        await self.invite_all(donut_room_id, [user_id for user_id in invitees if user_id not in joined])
+        return True
+
+    async def leave_unused_donut_rooms(self) -> int:
+        """Leave DONUT rooms no group has gone back to in ``donut_rooms.keep_days``.
+
+        At most ``donut_rooms.leave_batch`` rooms are left per call. Returns how many were.
+        """
+        keep_days = self.config["donut_rooms.keep_days"]
+        if keep_days <= 0:
+            return 0
+        used_before = _now_ms() - int(keep_days * 24 * 60 * 60 * 1000)
+        unused = await db.get_unused_donut_rooms(self.database, used_before, self.config["donut_rooms.leave_batch"])
+        async def leave(donut_room_id: RoomID) -> None:
+            try:
+                await self.limiter.call(self.api.leave_room, donut_room_id)
+            except (MForbidden, MNotFound):
+                # Already gone
+                pass
+        errors = await run_bounded(unused, leave, concurrency=self.config["donut_rooms.leave_concurrency"])
+        left = [r for r, e in zip(unused, errors) if e is None]
+        await db.delete_donut_rooms(self.database, left)
+        self.metrics.rooms_left.inc(amount=len(left))
+        for donut_room_id, e in zip(unused, errors):
+            if e is not None:
+                warn(f"Error leaving DONUT room {donut_room_id}: {e}")
+        if left:
+            info(f"Left {len(left)} unused DONUT rooms")
+        return len(left)
+
+    def _progress_reporter(self, respond: Responder) -> ProgressCallback:
+        interval = self.config["room_creation.progress_interval"]
+        started = last_report = time.monotonic()
+        async def report(done: int, total: int) -> None:
+            nonlocal last_report
+            now = time.monotonic()
+            if interval <= 0 or done == total or now - last_report < interval:
+                return
+            last_report = now
+            remaining = (now - started) / done * (total - done)
+            await respond(f"Set up {done} of {total} DONUT rooms, about {remaining:.0f}s to go")
+        return report
+
+    #### Proposed donuts ####
+
+    async def get_proposed_donut(self, room_id: RoomID) -> Optional[Donut]:
+        table = self.member_table(room_id)
+        groups = self.proposed_donuts.get(room_id)
+        if groups is not None:
+            return table.to_donut(groups)
+        row = await db.get_proposal(self.database, room_id)
+        if row is None:
+            return None
+        donut_json, created_at = row
+        expires_at = created_at / 1000 + self.config["proposal_ttl"]
+        if expires_at <= time.time():
+            await db.delete_proposal(self.database, room_id)
+            return None
+        # Proposals from before display names were dropped hold [mxid, display_name] pairs
+        donut_round = [[m if isinstance(m, str) else m[0] for m in group] for group in json.loads(donut_json)]
+        groups = table.groups(donut_round)
+        self.proposed_donuts.put(room_id, groups, expires_at=expires_at)
+        return table.to_donut(groups)
+
+    async def set_proposed_donut(self, room_id: RoomID, groups: List[Group]):
+        now = _now_ms()
+        donut_json = json.dumps(self.member_table(room_id).to_round(groups), separators=(",", ":"))
+        await db.put_proposal(self.database, room_id, donut_json, now)
+        self.proposed_donuts.expire()
+        self.proposed_donuts.put(room_id, groups)
+        await db.delete_expired_proposals(self.database, now - self.config["proposal_ttl"] * 1000)
+
+    async def clear_proposed_donut(self, room_id: RoomID):
+        self.proposed_donuts.pop(room_id)
+        await db.delete_proposal(self.database, room_id)
+
+    #### Rounds ####
+
+    async def propose_donut(self, room_id: RoomID, group_size: int) -> Donut:
+        members = await self.get_members(room_id)
+        history = await self.get_history(room_id)
+        table = self.member_table(room_id)
+        groups = await self.assign_donut(table, members, group_size, history)
+        await self.set_proposed_donut(room_id, groups)
+        return table.to_donut(groups)
+
+    async def confirm_donut(self, room_id: RoomID, respond: Responder) -> bool:
+        """Save the proposed donut and set up its rooms. False if nothing was proposed.
+
+        If an earlier confirm of the same proposal failed partway, this one only
+        does what's left: the round isn't saved twice and finished rooms are kept.
+        """
+        proposed_donut = await self.get_proposed_donut(room_id)
+        if not proposed_donut:
+            return False
+        if not await db.is_proposal_confirmed(self.database, room_id):
+            try:
+                await self.set_current_donut(proposed_donut, room_id)
+                await db.mark_proposal_confirmed(self.database, room_id, _now_ms())
+                info("New DONUT saved for room_id: " + room_id);
+            except Exception as e:
+                await respond("Error saving state: " + str(e))
+                warn("Error saving DONUT for room_id " + room_id, e);
+                return True
+            await self.respond_donut(room_id, respond, proposed_donut, "Newly proposed DONUT created!")
+        try:
+            already_done = await self.invite_users_to_donut(room_id, proposed_donut,
+                                                            self._progress_reporter(respond))
+            info("Everyone invited for DONUT in room_id: " + room_id);
+        except Exception as e:
+            await respond("Error inviting everyone to DONUT: " + str(e))
+            warn("Error inviting everyone to DONUT for room_id " + room_id, e);
+            return True
+        message = "Everyone invited to DONUT rooms!"
+        if already_done:
+            message += f" ({already_done} of them were set up by an earlier try)"
+        await self.respond_donut(room_id, respond, proposed_donut, message)
+        await self.clear_proposed_donut(room_id)
+        return True
+
+    async def repair_donut(self, room_id: RoomID, respond: Responder, group_size: Optional[int] = None) -> bool:
+        """Fit the current donut to who's in the room now. False if there's no current donut.
+
+        Only the groups that changed are touched: newcomers are invited to their
+        group's existing room and brand-new groups get a room of their own.
+        Each group's progress goes to the setup journal and the round isn't saved
+        until every room is done, so running it again after an error picks up the
+        groups that are left.
+        """
+        parsed = await self.get_parsed_state(room_id)
+        old_groups = parsed.current_groups
+        if not old_groups:
+            return False
+        table = self.member_table(room_id)
+        present = {table.intern(m.mxid) for m in await self.get_members(room_id)}
+        grouped = {i for group in old_groups for i in group}
+        left = len(grouped - present)
+        joined = len(present - grouped)
+        if not left and not joined:
+            await respond("Everyone in THE DONUT is already in a group")
+            return True
+        history = parsed.history
+        recent_rounds = self.config["avoid_repeat_rounds"]
+        def cost(a: int, b: int) -> int:
+            return history.repeat_cost(a, b, recent_rounds)
+        repaired = repair_groups(old_groups, sorted(present), group_size or _usual_group_size(old_groups), cost)
+        changed = [g for g in repaired if g.origin is None or set(g.members) != set(old_groups[g.origin])]
+        old_rooms = await db.get_donut_rooms(self.database, room_id)
+        journal = await db.get_setup(self.database, room_id)
+        mxids = table.mxids
+        def to_members(group: Iterable[int]) -> List[SimpleMember]:
+            return [SimpleMember(display_name=None, mxid=mxids[i]) for i in group]
+        async def set_up(group: RepairedGroup) -> None:
+            new_group = to_members(group.members)
+            new_key = _group_key(new_group)
+            journal_key = db.REPAIR_PREFIX + new_key
+            setup = journal.get(journal_key, _NOT_STARTED)
+            if setup.step >= db.SETUP_WELCOMED:
+                # Done by an earlier repair that failed somewhere else
+                return
+            old_group = old_groups[group.origin] if group.origin is not None else ()
+            old_key = _group_key(to_members(old_group))
+            donut_room_id = old_rooms.get(old_key)
+            added = to_members(i for i in group.members if i not in old_group)
+            if old_group and not added:
+                # Only lost members; the room stays as it is
+                if donut_room_id:
+                    await db.put_donut_room(self.database, room_id, new_key, donut_room_id, _now_ms())
+                    await db.delete_donut_room(self.database, room_id, old_key)
+                return
+            if (setup.step < db.SETUP_CREATED and donut_room_id
+                    and await self.reopen_donut_room(donut_room_id, [UserID(m.mxid) for m in added])):
+                setup = db.SetupStep(db.SETUP_CREATED, donut_room_id)
+                await db.record_setup(self.database, room_id, journal_key, setup.step, donut_room_id)
+            if setup.step >= db.SETUP_CREATED and setup.donut_room_id == donut_room_id:
+                names = ", ".join(formatting.member_name(m) for m in await self.with_names(room_id, added))
+                await self.limiter.call(self.api.send_text, donut_room_id,
+                                        f"{names} joined this DONUT group. Say hi!")
+                await db.record_setup(self.database, room_id, journal_key, db.SETUP_WELCOMED, donut_room_id)
+                await db.put_donut_room(self.database, room_id, new_key, donut_room_id, _now_ms())
+                await db.delete_donut_room(self.database, room_id, old_key)
+            else:
+                await self.create_donut_room(room_id, new_group, setup, journal_key=journal_key)
+        errors = await run_bounded(changed, set_up, concurrency=self.config["room_creation.concurrency"])
+        failed = [e for e in errors if e is not None]
+        for e in failed:
+            warn(f"Error repairing a DONUT group in {room_id}: {e}")
+        if failed:
+            await respond(f"{len(failed)} of {len(changed)} changed DONUT groups could not be set up "
+                          f"(first error: {failed[0]}). Repair again to retry just those")
+            return True
+        await self.replace_current_donut(table.to_donut(g.members for g in repaired), room_id)
+        await db.delete_repair_setup(self.database, room_id)
+        info(f"DONUT repaired in {room_id}: {joined} joined, {left} left, {len(changed)} groups changed")
+        await self.respond_donut(room_id, respond, table.to_donut(g.members for g in changed),
+                                 f"DONUT repaired for {joined} new and {left} departed members. Changed groups:")
+        return True
+
+    #### Scheduled rounds ####
+
+    async def run_scheduler(self) -> None:
+        while True:
+            try:
+                await self.run_due_rounds()
+            except Exception as e:
+                warn(f"Error running scheduled DONUTs: {e}")
+            try:
+                await self.leave_unused_donut_rooms()
+            except Exception as e:
+                warn(f"Error leaving unused DONUT rooms: {e}")
+            try:
+                await self.fill_room_pool()
+            except Exception as e:
+                warn(f"Error filling the DONUT room pool: {e}")
+            await asyncio.sleep(self.config["schedule.tick"])
+
+    async def run_due_rounds(self) -> None:
+        now = _now_ms()
+        due = await db.get_due_schedules(self.database, now, self.config["schedule.batch"])
+        async def run(scheduled: db.ScheduledRound) -> None:
+            try:
+                schedule = Schedule(scheduled.spec)
+                next_run = self.plan_next_run(schedule, scheduled.planned_at, now)
+            except ValueError as e:
+                warn(f"Dropping broken DONUT schedule {scheduled.spec!r} in {scheduled.room_id}: {e}")
+                await db.delete_schedule(self.database, scheduled.room_id)
+                return
+            # Move on to the next run first, so a crash or restart can't repeat this one
+            if not await db.claim_next_run(self.database, scheduled, *next_run):
+                return
+            if now - scheduled.run_at > self.config["schedule.missed_grace"] * 1000:
+                info(f"Skipping scheduled DONUT in {scheduled.room_id} that was missed while we were away")
+                return
+            await self.propose_donut(scheduled.room_id, scheduled.group_size)
+            await self.confirm_donut(scheduled.room_id, self.room_responder(scheduled.room_id))
+        errors = await run_bounded(due, run, concurrency=self.config["schedule.concurrency"])
+        for scheduled, e in zip(due, errors):
+            if e is not None:
+                warn(f"Error running scheduled DONUT in {scheduled.room_id}: {e}")
+
+    def plan_next_run(self, schedule: Schedule, previous: Optional[int], now: int) -> Tuple[int, int]:
+        """When the next run is due by ``schedule`` and, with jitter, when it actually starts."""
+        tz = self._timezone()
+        planned = to_ms(schedule.next_after(localize(previous, tz) if previous else None, localize(now, tz)))
+        return planned, planned + int(random.uniform(0, self.config["schedule.jitter"]) * 1000)
+
+    def _timezone(self) -> tzinfo:
+        try:
+            return ZoneInfo(self.config["schedule.timezone"])
+        except (ZoneInfoNotFoundError, ValueError):
+            warn(f"Unknown time zone {self.config['schedule.timezone']}, using UTC instead")
+            return ZoneInfo("UTC")
+
+    def _format_time(self, timestamp_ms: int) -> str:
+        return localize(timestamp_ms, self._timezone()).strftime("%B %d, %Y %H:%M %Z")
+
+    #### Grouping ####
+
+    async def assign_donut(self, table: MemberTable, member_list: List[SimpleMember], group_size: int,
+                           history: PairingHistory) -> List[Group]:
+        members = sorted({table.intern(m.mxid) for m in member_list})
+        # Only plain data goes to _compute_groups so it can run in another process,
+        # and ids keep it small
+        costs = history.pair_costs(members, self.config["avoid_repeat_rounds"])
+        args = (members, group_size, costs,
+                self.config["grouping_time_budget"],
+                self.config["grouping_mode"],
+                self.config["grouping_candidates"],
+                self.config["vectorized_max_members"])
+        pool = self._get_pool() if len(members) >= self.config["offload_min_members"] else None
+        # Anything else goes to a thread, so even a search that uses its whole time
+        # budget doesn't hold up the event loop
+        return await self.loop.run_in_executor(pool, _compute_groups, *args)
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        # Workers must be forked: plugin modules are loaded by maubot's own importer,
+        # so a freshly spawned interpreter couldn't find _compute_groups
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        if not self.pool:
+            self.pool = ProcessPoolExecutor(max_workers=self.config["offload_workers"],
+                                            mp_context=multiprocessing.get_context("fork"))
+        return self.pool
+
+    #### Responses ####
+
+    async def respond_donut(self, room_id: RoomID, respond: Responder, donut: Donut, message: str = "") -> None:
+        named = await self.with_names(room_id, (m for group in donut for m in group))
+        by_mxid = {m.mxid: m for m in named}
+        donut = Donut({frozenset(by_mxid[m.mxid] for m in group) for group in donut})
+        for content in _format_donut(donut, message, self.config["message_format"] == "html",
+                                     self.config["message_max_bytes"]):
+            await respond(content)
+
+    async def respond_members(self, room_id: RoomID, respond: Responder, members: List[SimpleMember],
+                              message: str = "") -> None:
+        members = await self.with_names(room_id, members)
+        for content in _format_members(members, message, self.config["message_format"] == "html",
+                                       self.config["message_max_bytes"]):
+            await respond(content)
+
+    def room_responder(self, room_id: RoomID) -> Responder:
+        """Send to a room like MessageEvent.respond does, for when there's no command to respond to."""
+        async def respond(content: Union[str, MessageEventContent]) -> EventID:
+            if isinstance(content, str):
+                content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=content,
+                                                  format=Format.HTML, formatted_body=markdown.render(content))
+            return await self.api.send_message(room_id, content)
+        return respond
+
+    #### Web ####
+
+    @web.get("/metrics")
+    async def get_metrics(self, request: Request) -> Response:
+        return Response(text=self.metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
 
     #### Bot Commands ####
 
@@ -121,129 +835,187 @@ class DonutBot(Plugin):
         pass
 
     @base_command.subcommand(help="List members in THE DONUT")
+    @timed("list")
     async def list(self, evt: MessageEvent) -> None:
-        members = await self.get_members(evt)
+        members = await self.get_members(evt.room_id)
         if members:
-            await evt.respond("Members in THE DONUT:\n" + _format_members(members))
+            await self.respond_members(evt.room_id, evt.respond, members, "Members in THE DONUT:")
         else:
             await evt.respond("No members found in THE DONUT")
 
     @base_command.subcommand(help="Start a new DONUT")
     @command.argument("group_size", required=False, parser=_str_to_int)
+    @timed("new")
     async def new(self, evt: MessageEvent, group_size: Union[int, None] = None) -> None:
         group_size = group_size if group_size != None else 2
-        room_id = evt.room_id
-        new_donut = _generate_donut(await self.get_members(evt), group_size)
-        last_donut = await self.get_last_donut(room_id)
-        if (last_donut):
-            for _ in range(10):
-                if _are_donuts_overlapping(last_donut, new_donut):
-                    new_donut = _generate_donut(await self.get_members(evt), group_size)
-                    break
-        self.proposed_donuts[room_id] = new_donut
-        await evt.respond(_format_donut(new_donut, "New PROPOSED DONUT: (`!donut confirm` to confirm)"))
+        new_donut = await self.propose_donut(evt.room_id, group_size)
+        history = await self.get_history(evt.room_id)
+        # Small rooms can't always avoid it, so say how many pairs meet again
+        repeats = history.repeat_pairs(self.member_table(evt.room_id).from_donut(new_donut), len(history) - 1)
+        again = f" (pairs together again from the current DONUT: {repeats})" if repeats else ""
+        await self.respond_donut(evt.room_id, evt.respond, new_donut,
+                                 f"New PROPOSED DONUT{again}: (`!donut confirm` to confirm)")
 
     @base_command.subcommand(help="Confirm new DONUT")
+    @timed("confirm")
     async def confirm(self, evt: MessageEvent) -> None:
-        room_id = evt.room_id
-        proposed_donut = self.proposed_donuts.get(room_id)
-        if (proposed_donut):
-            try:
-                await self.set_current_donut(proposed_donut, room_id)
-                info("New DONUT saved for room_id: " + room_id);
-            except Exception as e:
-                await evt.respond("Error saving state: " + str(e))
-                warn("Error saving DONUT for room_id " + room_id, e);
-                return
-            await evt.respond(_format_donut(proposed_donut, "Newly proposed DONUT created!"))
-            try:
-                await self.invite_users_to_donut(proposed_donut)
-                info("Everyone invited for DONUT in room_id: " + room_id);
-            except Exception as e:
-                await evt.respond("Error inviting everyone to DONUT: " + str(e))
-                warn("Error inviting everyone to DONUT for room_id " + room_id, e);
-                return
-            await evt.respond(_format_donut(proposed_donut, "Everyone invited to DONUT rooms!"))
-            self.proposed_donuts.pop(room_id)
-        else:
+        if not await self.confirm_donut(evt.room_id, evt.respond):
             await evt.respond("No DONUT currently proposed. Use `!donut new` to make a new one")
 
+    @base_command.subcommand(help="Update the current DONUT for people who joined or left since")
+    @command.argument("group_size", required=False, parser=_str_to_int)
+    @timed("repair")
+    async def repair(self, evt: MessageEvent, group_size: Union[int, None] = None) -> None:
+        if not await self.repair_donut(evt.room_id, evt.respond, group_size):
+            await evt.respond("No DONUT in progress. Use `!donut new` to make a new one")
+
     @base_command.subcommand(help="View the current DONUT")
+    @timed("current")
     async def current(self, evt: MessageEvent) -> None:
         d = await self.get_current_donut(evt.room_id)
         if d:
-            await evt.respond(_format_donut(d))
+            await self.respond_donut(evt.room_id, evt.respond, d)
         else:
             await evt.respond("No DONUT in progress. Use `!donut new` to make a new one")
 
     @base_command.subcommand(help="View the previous DONUT")
+    @timed("previous")
     async def previous(self, evt: MessageEvent) -> None:
         d = await self.get_last_donut(evt.room_id)
         if d:
-            await evt.respond(_format_donut(d))
+            await self.respond_donut(evt.room_id, evt.respond, d)
         else:
             await evt.respond("No previous DONUT. Use `!donut new` to make a new one")
 
+    @base_command.subcommand(help="List who someone has been in a DONUT with")
+    @command.argument("user")
+    @command.argument("days", required=False, parser=_str_to_int)
+    @timed("met")
+    async def met(self, evt: MessageEvent, user: str, days: Union[int, None] = None) -> None:
+        days = days if days != None else 180
+        # Make sure the store has this room's history
+        await self.get_parsed_state(evt.room_id)
+        since = _now_ms() - days * 24 * 60 * 60 * 1000
+        partners = await self.store.get_partners(evt.room_id, user, since)
+        # Rounds imported from room state have no time, so they may be from before
+        dated = {p.user_id for p in partners if p.created_at is not None}
+        if not partners and not self.store.records_times:
+            await evt.respond(f"{user} hasn't been in a DONUT")
+        elif not partners:
+            await evt.respond(f"{user} hasn't been in a DONUT in the last {days} days")
+        elif not dated:
+            await evt.respond(f"{user} met, at a time that isn't known:\n" +
+                              await self._format_partners(evt.room_id, partners, dated))
+        else:
+            await evt.respond(f"{user} met in the last {days} days:\n" +
+                              await self._format_partners(evt.room_id, partners, dated))
+
+    async def _format_partners(self, room_id: RoomID, partners: List[db.Partner], dated: Set[str]) -> str:
+        # One line per person, even when two of them have the same display name
+        found = await self.get_display_names(room_id, {p.user_id for p in partners})
+        lines = sorted((name or mxid, mxid) for mxid, name in found.items())
+        return "".join(f" - {name}\n" if mxid in dated else f" - {name} (date unknown)\n"
+                       for name, mxid in lines)
+
+    @base_command.subcommand(help="Run DONUTs on a schedule, e.g. `2 @every 2w` or `3 0 10 * * 1`")
+    @command.argument("group_size", required=False, parser=_str_to_int)
+    @command.argument("spec", required=False, pass_raw=True)
+    @timed("schedule")
+    async def schedule(self, evt: MessageEvent, group_size: Union[int, None] = None,
+                       spec: Union[str, None] = None) -> None:
+        if group_size is None or not spec:
+            scheduled = await db.get_schedule(self.database, evt.room_id)
+            if group_size is None and not spec and scheduled:
+                await evt.respond(f"DONUTs in groups of {scheduled.group_size} run on the schedule "
+                                  f"`{scheduled.spec}`. The next one starts around "
+                                  f"{self._format_time(scheduled.run_at)}")
+            else:
+                await evt.respond("Use `!donut schedule <group size> <schedule>`, where the schedule is a cron "
+                                  "expression like `0 10 * * 1` or an interval like `@every 2w`")
+            return
+        try:
+            schedule = Schedule(spec)
+            planned_at, run_at = self.plan_next_run(schedule, None, _now_ms())
+        except ValueError as e:
+            await evt.respond(f"Can't use the schedule `{spec}`: {e}")
+            return
+        await db.put_schedule(self.database, db.ScheduledRound(evt.room_id, str(schedule), group_size,
+                                                               planned_at, run_at))
+        await evt.respond(f"DONUTs in groups of {group_size} will run on the schedule `{schedule}`. "
+                          f"The first one starts around {self._format_time(run_at)}")
+
+    @base_command.subcommand(help="Stop scheduled DONUTs")
+    @timed("unschedule")
+    async def unschedule(self, evt: MessageEvent) -> None:
+        await db.delete_schedule(self.database, evt.room_id)
+        await evt.respond("No more scheduled DONUTs. Use `!donut schedule` to start again")
+
     @base_command.subcommand(help="Generate a sample DONUT")
     @command.argument("group_size", required=False, parser=_str_to_int)
+    @timed("sample")
     async def sample(self, evt: MessageEvent, group_size: Union[int, None] = None) -> None:
         group_size = group_size if group_size != None else 2
-        d = _generate_donut(await self.get_members(evt), group_size)
-        await evt.respond(_format_donut(d))
-
-def _json_to_donut(jsonDonut: Lst) -> Donut:
-    newDonut = Donut(set())
-    for jsonGroup in jsonDonut:
-        newGroup: Set[SimpleMember] = set()
-        for jsonMember in jsonGroup:
-            newMember = SimpleMember(jsonMember.display_name, jsonMember.mxid)
-            newGroup.add(newMember)
-        newDonut.add(frozenset(newGroup))
-    return newDonut
-
-def _donut_to_json(donut: Donut) -> Lst:
-    newJsonDonut: List[List[Obj]] = list()
-    for group in donut:
-        newJsonGroup: List[Obj] = list()
-        for member in group:
-            newJsonMember = Obj()
-            newJsonMember["display_name"] = member.display_name
-            newJsonMember["mxid"] = member.mxid
-            newJsonGroup.append(newJsonMember)
-        newJsonDonut.append(newJsonGroup)
-    return Lst(newJsonDonut)
-
-def _generate_donut(member_list: List[SimpleMember], group_size: int) -> Donut:
-    random_list = member_list.copy()
-    random.shuffle(random_list)
-    donut: Donut = Donut(set())
-    while len(random_list) > 0:
-        group: Set[SimpleMember] = set()
-        for _ in range(min(group_size, len(random_list))):
-            group.add(random_list.pop())
-        if 0 < len(random_list) <= floor(group_size/2):
-            group.update(random_list)
-            random_list.clear()
-        donut.add(frozenset(group))
-    return donut
-
-def _are_donuts_overlapping(d1: Donut, d2: Donut) -> bool:
-    for group in d1:
-        if group in d2:
-            return True
-    return False
-
-def _format_donut(donut: Donut, message: str = "") -> str:
-    if len(message) > 0:
-        message = message + "\n"
-    for group in donut:
-        message = message + " - "
-        message = message + ", ".join([(m.display_name if m.display_name else m.mxid) for m in group])
-        message = message + "\n"
-    return message
-
-def _format_members(member_list: List[SimpleMember]) -> str:
-    s: str = ""
-    for m in member_list:
-        s = s + " - " + (m.display_name if m.display_name else m.mxid) + "\n"
-    return s
+        table = self.member_table(evt.room_id)
+        members = [table.intern(m.mxid) for m in await self.get_members(evt.room_id)]
+        await self.respond_donut(evt.room_id, evt.respond, table.to_donut(_generate_donut(members, group_size)))
+
+# Setup journal entry of a group that hasn't been started
+_NOT_STARTED = db.SetupStep(0, None)
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _donut_room_state() -> List[Dict[str, Any]]:
+    return [{
+        "content": {"history_visibility": "invited"},
+        "type": "m.room.history_visibility",
+        "state_key": "",
+    }, {
+        "content": RoomEncryptionStateEventContent(EncryptionAlgorithm.MEGOLM_V1).serialize(),
+        "type": str(EventType.ROOM_ENCRYPTION),
+        "state_key": "",
+    }]
+
+def _group_key(group: Iterable[SimpleMember]) -> str:
+    return "\n".join(sorted(m.mxid for m in group))
+
+def _usual_group_size(groups: Iterable[Group]) -> int:
+    # The round's group size; only a group that took in the remainder is bigger
+    sizes = Counter(len(group) for group in groups)
+    return max(sizes, key=lambda size: (sizes[size], -size))
+
+def _rounds_to_parsed_state(rounds: List[Round], table: MemberTable) -> ParsedDonutState:
+    interned = [table.groups(r) for r in rounds]
+    return ParsedDonutState(current_groups=interned[-1] if interned else None,
+                            last_groups=interned[-2] if len(interned) > 1 else None,
+                            history=PairingHistory(interned))
+
+def _generate_donut(members: Sequence[int], group_size: int) -> List[Group]:
+    order = list(members)
+    random.shuffle(order)
+    groups: List[Group] = []
+    start = 0
+    for size in group_sizes(len(order), group_size):
+        groups.append(tuple(sorted(order[start:start + size])))
+        start += size
+    return groups
+
+def _compute_groups(members: List[int], group_size: int, costs: Dict[Tuple[int, int], int],
+                    time_budget: float, mode: str, candidates: int, vectorized_max_members: int) -> List[Group]:
+    def cost(a: int, b: int) -> int:
+        return costs.get(id_pair(a, b), 0)
+    # The cost matrix is dense, n² 4-byte ints, so big rooms are searched instead
+    if mode == "vectorized" and vectorized.available() and len(members) <= vectorized_max_members:
+        matrix = vectorized.cost_matrix(members, costs, cost)
+        groups = vectorized.best_of_random(members, group_size, matrix, candidates)
+    else:
+        groups = assign_groups(members, group_size, cost, time_budget)
+    return [tuple(sorted(group)) for group in groups]
+
+def _format_donut(donut: Donut, message: str = "", html: bool = False,
+                  max_bytes: int = formatting.MAX_MESSAGE_BYTES) -> List[TextMessageEventContent]:
+    return formatting.render(message, formatting.donut_lines(donut, html), max_bytes)
+
+def _format_members(member_list: List[SimpleMember], message: str = "", html: bool = False,
+                    max_bytes: int = formatting.MAX_MESSAGE_BYTES) -> List[TextMessageEventContent]:
+    return formatting.render(message, formatting.member_lines(member_list, html), max_bytes)
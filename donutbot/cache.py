@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Optional, Tuple, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+class LRUCache(Generic[K, V]):
+    """Least-recently-used cache whose entries also expire after ``ttl`` seconds.
+
+    ``size_of`` gives the weight of a value; the oldest entries are evicted once
+    the total weight goes over ``max_size``.
+    """
+
+    def __init__(self, max_size: int, ttl: float, size_of: Callable[[V], int] = lambda _: 1) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size_of = size_of
+        self.size = 0
+        self.entries: "OrderedDict[K, Tuple[V, float, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, _ = entry
+        if expires_at <= time.time():
+            self.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V, expires_at: Optional[float] = None) -> None:
+        self.pop(key)
+        size = self.size_of(value)
+        self.entries[key] = (value, expires_at or time.time() + self.ttl, size)
+        self.size += size
+        while self.size > self.max_size and self.entries:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[2]
+        return entry[0]
+
+    def expire(self) -> int:
+        now = time.time()
+        expired = [key for key, (_, expires_at, _) in self.entries.items() if expires_at <= now]
+        for key in expired:
+            self.pop(key)
+        return len(expired)
@@ -0,0 +1,396 @@
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from mautrix.types.primitive import RoomID
+from mautrix.util.async_db import Connection, Database, UpgradeTable
+
+from .donut import Round
+
+upgrade_table = UpgradeTable()
+
+# How far a group's room has been set up during a confirm
+SETUP_CREATED = 1
+SETUP_WELCOMED = 2
+# Group keys in the journal of a repair start with this. They're kept when a
+# proposal comes or goes, and dropped once the current round changes.
+REPAIR_PREFIX = "repair:"
+
+class SetupStep(NamedTuple):
+    step: int
+    donut_room_id: Optional[RoomID]
+
+class ScheduledRound(NamedTuple):
+    room_id: RoomID
+    spec: str
+    group_size: int
+    # When the next round is due by the schedule, and when it actually runs (with jitter)
+    planned_at: int
+    run_at: int
+
+class Partner(NamedTuple):
+    user_id: str
+    round: int
+    # None for rounds imported from room state, whose time isn't known
+    created_at: Optional[int]
+
+@upgrade_table.register(description="Initial revision")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE proposed_donut (
+            room_id    TEXT PRIMARY KEY,
+            donut      TEXT NOT NULL,
+            created_at BIGINT NOT NULL
+        )"""
+    )
+    await conn.execute("CREATE INDEX proposed_donut_created_at_idx ON proposed_donut (created_at)")
+
+@upgrade_table.register(description="Add donut history tables")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE donut_round (
+            room_id    TEXT NOT NULL,
+            round      INTEGER NOT NULL,
+            created_at BIGINT,
+            PRIMARY KEY (room_id, round)
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE donut_group (
+            room_id     TEXT NOT NULL,
+            round       INTEGER NOT NULL,
+            group_index INTEGER NOT NULL,
+            PRIMARY KEY (room_id, round, group_index),
+            FOREIGN KEY (room_id, round) REFERENCES donut_round (room_id, round) ON DELETE CASCADE
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE donut_member (
+            room_id     TEXT NOT NULL,
+            round       INTEGER NOT NULL,
+            group_index INTEGER NOT NULL,
+            user_id     TEXT NOT NULL,
+            PRIMARY KEY (room_id, round, user_id),
+            FOREIGN KEY (room_id, round, group_index)
+                REFERENCES donut_group (room_id, round, group_index) ON DELETE CASCADE
+        )"""
+    )
+    await conn.execute("CREATE INDEX donut_member_user_idx ON donut_member (room_id, user_id)")
+
+@upgrade_table.register(description="Add round schedules")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE donut_schedule (
+            room_id    TEXT PRIMARY KEY,
+            spec       TEXT NOT NULL,
+            group_size INTEGER NOT NULL,
+            planned_at BIGINT NOT NULL,
+            run_at     BIGINT NOT NULL
+        )"""
+    )
+    await conn.execute("CREATE INDEX donut_schedule_run_at_idx ON donut_schedule (run_at)")
+
+@upgrade_table.register(description="Add confirm journal")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE proposed_donut ADD COLUMN confirmed_at BIGINT")
+    # When the confirmed round was written to room state, which happens first
+    await conn.execute("ALTER TABLE proposed_donut ADD COLUMN saved_at BIGINT")
+    await conn.execute(
+        """CREATE TABLE donut_setup (
+            room_id       TEXT NOT NULL,
+            group_key     TEXT NOT NULL,
+            step          INTEGER NOT NULL,
+            donut_room_id TEXT,
+            PRIMARY KEY (room_id, group_key)
+        )"""
+    )
+
+@upgrade_table.register(description="Add DONUT room index")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE donut_room (
+            room_id       TEXT NOT NULL,
+            group_key     TEXT NOT NULL,
+            donut_room_id TEXT NOT NULL,
+            last_used     BIGINT NOT NULL,
+            PRIMARY KEY (room_id, group_key)
+        )"""
+    )
+    await conn.execute("CREATE INDEX donut_room_donut_room_id_idx ON donut_room (donut_room_id)")
+    await conn.execute("CREATE INDEX donut_room_last_used_idx ON donut_room (last_used)")
+
+@upgrade_table.register(description="Add spare room pool")
+async def upgrade_v6(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE spare_room (
+            donut_room_id TEXT PRIMARY KEY,
+            created_at    BIGINT NOT NULL
+        )"""
+    )
+
+#### Donut history ####
+
+async def get_rounds(db: Database, room_ids: Sequence[RoomID]) -> Dict[RoomID, List[Round]]:
+    rounds: Dict[RoomID, List[Round]] = {room_id: list() for room_id in room_ids}
+    if not room_ids:
+        return rounds
+    placeholders = ", ".join(f"${i + 1}" for i in range(len(room_ids)))
+    rows = await db.fetch(
+        f"""SELECT room_id, round, group_index, user_id FROM donut_member
+            WHERE room_id IN ({placeholders}) ORDER BY room_id, round, group_index""",
+        *room_ids,
+    )
+    key = group_key = None
+    for row in rows:
+        room_rounds = rounds[row["room_id"]]
+        if (row["room_id"], row["round"]) != key:
+            room_rounds.append([])
+            key, group_key = (row["room_id"], row["round"]), None
+        if row["group_index"] != group_key:
+            room_rounds[-1].append([])
+            group_key = row["group_index"]
+        room_rounds[-1][-1].append(row["user_id"])
+    return rounds
+
+async def add_rounds(db: Database, rounds: Dict[RoomID, Round], created_at: int) -> None:
+    """Add one new round to each room, numbered after the room's latest round."""
+    async with db.acquire() as conn, conn.transaction():
+        for room_id, groups in rounds.items():
+            round_no = await conn.fetchval(
+                "SELECT COALESCE(MAX(round) + 1, 0) FROM donut_round WHERE room_id=$1", room_id
+            )
+            await _insert_round(conn, room_id, round_no, created_at, groups)
+
+async def replace_rounds(db: Database, histories: Dict[RoomID, List[Round]]) -> None:
+    """Replace whole room histories, e.g. when importing them from Matrix state.
+
+    Rounds already stored with the same number and groups are left alone and keep
+    their time. The original times of new or changed rounds aren't known, so
+    they're stored as NULL.
+    """
+    async with db.acquire() as conn, conn.transaction():
+        for room_id, rounds in histories.items():
+            stored = await _get_round_groups(conn, room_id)
+            for round_no, groups in enumerate(rounds):
+                old_groups = stored.pop(round_no, None)
+                if old_groups == {frozenset(group) for group in groups}:
+                    continue
+                if old_groups is not None:
+                    await _delete_round(conn, room_id, round_no)
+                await _insert_round(conn, room_id, round_no, None, groups)
+            for round_no in stored:
+                await _delete_round(conn, room_id, round_no)
+
+async def replace_latest_rounds(db: Database, rounds: Dict[RoomID, Round]) -> None:
+    """Replace the groups of each room's latest round, keeping its number and time."""
+    async with db.acquire() as conn, conn.transaction():
+        for room_id, groups in rounds.items():
+            round_no = await conn.fetchval("SELECT MAX(round) FROM donut_round WHERE room_id=$1", room_id)
+            if round_no is None:
+                continue
+            await conn.execute("DELETE FROM donut_member WHERE room_id=$1 AND round=$2", room_id, round_no)
+            await conn.execute("DELETE FROM donut_group WHERE room_id=$1 AND round=$2", room_id, round_no)
+            await _insert_groups(conn, room_id, round_no, groups)
+
+async def get_partners(db: Database, room_id: RoomID, user_id: str, since: int) -> List[Partner]:
+    """Everyone who shared a group with ``user_id`` in a round created at or after ``since``.
+
+    Rounds whose time isn't known are included too.
+    """
+    rows = await db.fetch(
+        """SELECT other.user_id, r.round, r.created_at
+           FROM donut_member me
+           JOIN donut_round r ON r.room_id=me.room_id AND r.round=me.round
+           JOIN donut_member other ON other.room_id=me.room_id AND other.round=me.round
+                                  AND other.group_index=me.group_index
+           WHERE me.room_id=$1 AND me.user_id=$2 AND other.user_id<>$2 AND (r.created_at IS NULL OR r.created_at>=$3)
+           ORDER BY r.round DESC""",
+        room_id, user_id, since,
+    )
+    return [Partner(row["user_id"], row["round"], row["created_at"]) for row in rows]
+
+async def _get_round_groups(conn: Connection, room_id: RoomID) -> Dict[int, Set[FrozenSet[str]]]:
+    rows = await conn.fetch(
+        """SELECT r.round, m.group_index, m.user_id FROM donut_round r
+           LEFT JOIN donut_member m ON m.room_id=r.room_id AND m.round=r.round
+           WHERE r.room_id=$1""",
+        room_id,
+    )
+    members: Dict[int, Dict[int, List[str]]] = dict()
+    for row in rows:
+        groups = members.setdefault(row["round"], dict())
+        if row["user_id"] is not None:
+            groups.setdefault(row["group_index"], []).append(row["user_id"])
+    return {round_no: {frozenset(group) for group in groups.values()} for round_no, groups in members.items()}
+
+async def _delete_round(conn: Connection, room_id: RoomID, round_no: int) -> None:
+    await conn.execute("DELETE FROM donut_member WHERE room_id=$1 AND round=$2", room_id, round_no)
+    await conn.execute("DELETE FROM donut_group WHERE room_id=$1 AND round=$2", room_id, round_no)
+    await conn.execute("DELETE FROM donut_round WHERE room_id=$1 AND round=$2", room_id, round_no)
+
+async def _insert_round(conn: Connection, room_id: RoomID, round_no: int, created_at: Optional[int],
+                        groups: Round) -> None:
+    await conn.execute("INSERT INTO donut_round (room_id, round, created_at) VALUES ($1, $2, $3)",
+                       room_id, round_no, created_at)
+    await _insert_groups(conn, room_id, round_no, groups)
+
+async def _insert_groups(conn: Connection, room_id: RoomID, round_no: int, groups: Round) -> None:
+    await conn.executemany("INSERT INTO donut_group (room_id, round, group_index) VALUES ($1, $2, $3)",
+                           [(room_id, round_no, i) for i in range(len(groups))])
+    await conn.executemany(
+        "INSERT INTO donut_member (room_id, round, group_index, user_id) VALUES ($1, $2, $3, $4)",
+        [(room_id, round_no, i, user_id) for i, group in enumerate(groups) for user_id in group],
+    )
+
+#### Proposed donuts ####
+
+async def get_proposal(db: Database, room_id: RoomID) -> Optional[Tuple[str, int]]:
+    row = await db.fetchrow("SELECT donut, created_at FROM proposed_donut WHERE room_id=$1", room_id)
+    return (row["donut"], row["created_at"]) if row else None
+
+async def put_proposal(db: Database, room_id: RoomID, donut: str, created_at: int) -> None:
+    await db.execute(
+        """INSERT INTO proposed_donut (room_id, donut, created_at) VALUES ($1, $2, $3)
+           ON CONFLICT (room_id) DO UPDATE SET donut=excluded.donut, created_at=excluded.created_at,
+                                               confirmed_at=NULL, saved_at=NULL""",
+        room_id, donut, created_at,
+    )
+    # A new proposal starts its setup from scratch
+    await db.execute("DELETE FROM donut_setup WHERE room_id=$1 AND group_key NOT LIKE $2",
+                     room_id, REPAIR_PREFIX + "%")
+
+async def delete_proposal(db: Database, room_id: RoomID) -> None:
+    async with db.acquire() as conn, conn.transaction():
+        await conn.execute("DELETE FROM proposed_donut WHERE room_id=$1", room_id)
+        await conn.execute("DELETE FROM donut_setup WHERE room_id=$1 AND group_key NOT LIKE $2",
+                           room_id, REPAIR_PREFIX + "%")
+
+async def delete_expired_proposals(db: Database, created_before: int) -> None:
+    async with db.acquire() as conn, conn.transaction():
+        await conn.execute("DELETE FROM proposed_donut WHERE created_at<$1", created_before)
+        await conn.execute(
+            """DELETE FROM donut_setup
+               WHERE room_id NOT IN (SELECT room_id FROM proposed_donut) AND group_key NOT LIKE $1""",
+            REPAIR_PREFIX + "%",
+        )
+
+async def is_proposal_confirmed(db: Database, room_id: RoomID) -> bool:
+    confirmed_at = await db.fetchval("SELECT confirmed_at FROM proposed_donut WHERE room_id=$1", room_id)
+    return confirmed_at is not None
+
+async def mark_proposal_confirmed(db: Database, room_id: RoomID, confirmed_at: int) -> None:
+    await db.execute("UPDATE proposed_donut SET confirmed_at=$2 WHERE room_id=$1", room_id, confirmed_at)
+
+async def get_proposal_saved_at(db: Database, room_id: RoomID) -> Optional[int]:
+    return await db.fetchval("SELECT saved_at FROM proposed_donut WHERE room_id=$1", room_id)
+
+async def mark_proposal_saved(db: Database, room_id: RoomID, saved_at: int) -> None:
+    await db.execute("UPDATE proposed_donut SET saved_at=$2 WHERE room_id=$1", room_id, saved_at)
+
+#### Confirm journal ####
+
+async def get_setup(db: Database, room_id: RoomID) -> Dict[str, SetupStep]:
+    rows = await db.fetch("SELECT group_key, step, donut_room_id FROM donut_setup WHERE room_id=$1", room_id)
+    return {row["group_key"]: SetupStep(row["step"], row["donut_room_id"]) for row in rows}
+
+_RECORD_SETUP = """INSERT INTO donut_setup (room_id, group_key, step, donut_room_id) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (room_id, group_key) DO UPDATE SET step=excluded.step,
+                                                                   donut_room_id=excluded.donut_room_id"""
+
+async def record_setup(db: Database, room_id: RoomID, group_key: str, step: int, donut_room_id: RoomID) -> None:
+    await db.execute(_RECORD_SETUP, room_id, group_key, step, donut_room_id)
+
+async def delete_repair_setup(db: Database, room_id: RoomID) -> None:
+    await db.execute("DELETE FROM donut_setup WHERE room_id=$1 AND group_key LIKE $2", room_id, REPAIR_PREFIX + "%")
+
+#### DONUT rooms ####
+
+async def get_donut_rooms(db: Database, room_id: RoomID) -> Dict[str, RoomID]:
+    """The DONUT room each group from ``room_id`` last met in, by group key."""
+    rows = await db.fetch("SELECT group_key, donut_room_id FROM donut_room WHERE room_id=$1", room_id)
+    return {row["group_key"]: RoomID(row["donut_room_id"]) for row in rows}
+
+async def put_donut_room(db: Database, room_id: RoomID, group_key: str, donut_room_id: RoomID,
+                         last_used: int) -> None:
+    await db.execute(
+        """INSERT INTO donut_room (room_id, group_key, donut_room_id, last_used) VALUES ($1, $2, $3, $4)
+           ON CONFLICT (room_id, group_key) DO UPDATE SET donut_room_id=excluded.donut_room_id,
+                                                          last_used=excluded.last_used""",
+        room_id, group_key, donut_room_id, last_used,
+    )
+
+async def delete_donut_room(db: Database, room_id: RoomID, group_key: str) -> None:
+    await db.execute("DELETE FROM donut_room WHERE room_id=$1 AND group_key=$2", room_id, group_key)
+
+async def get_unused_donut_rooms(db: Database, used_before: int, limit: int) -> List[RoomID]:
+    rows = await db.fetch(
+        """SELECT donut_room_id FROM donut_room GROUP BY donut_room_id
+           HAVING MAX(last_used)<$1 ORDER BY MAX(last_used) LIMIT $2""",
+        used_before, limit,
+    )
+    return [RoomID(row["donut_room_id"]) for row in rows]
+
+async def delete_donut_rooms(db: Database, donut_room_ids: Sequence[RoomID]) -> None:
+    await db.executemany("DELETE FROM donut_room WHERE donut_room_id=$1", [(r,) for r in donut_room_ids])
+
+#### Spare rooms ####
+
+async def count_spare_rooms(db: Database) -> int:
+    return await db.fetchval("SELECT COUNT(*) FROM spare_room")
+
+async def add_spare_room(db: Database, donut_room_id: RoomID, created_at: int) -> None:
+    await db.execute("INSERT INTO spare_room (donut_room_id, created_at) VALUES ($1, $2)",
+                     donut_room_id, created_at)
+
+async def take_spare_room(db: Database, room_id: RoomID, group_key: str) -> Optional[RoomID]:
+    """Move the oldest spare room from the pool to the setup journal as created for ``group_key``.
+
+    Both happen in one transaction, so a taken room is never lost track of.
+    Returns the room, or None if the pool is empty.
+    """
+    async with db.acquire() as conn, conn.transaction():
+        taken = await conn.fetchval(
+            """DELETE FROM spare_room WHERE donut_room_id=(
+                   SELECT donut_room_id FROM spare_room ORDER BY created_at LIMIT 1
+               ) RETURNING donut_room_id"""
+        )
+        if taken:
+            await conn.execute(_RECORD_SETUP, room_id, group_key, SETUP_CREATED, taken)
+    return RoomID(taken) if taken else None
+
+async def delete_spare_room(db: Database, donut_room_id: RoomID) -> None:
+    await db.execute("DELETE FROM spare_room WHERE donut_room_id=$1", donut_room_id)
+
+#### Schedules ####
+
+async def get_schedule(db: Database, room_id: RoomID) -> Optional[ScheduledRound]:
+    row = await db.fetchrow(
+        "SELECT room_id, spec, group_size, planned_at, run_at FROM donut_schedule WHERE room_id=$1", room_id
+    )
+    return ScheduledRound(*row) if row else None
+
+async def get_due_schedules(db: Database, now: int, limit: int) -> List[ScheduledRound]:
+    rows = await db.fetch(
+        """SELECT room_id, spec, group_size, planned_at, run_at FROM donut_schedule
+           WHERE run_at<=$1 ORDER BY run_at LIMIT $2""",
+        now, limit,
+    )
+    return [ScheduledRound(*row) for row in rows]
+
+async def put_schedule(db: Database, scheduled: ScheduledRound) -> None:
+    await db.execute(
+        """INSERT INTO donut_schedule (room_id, spec, group_size, planned_at, run_at) VALUES ($1, $2, $3, $4, $5)
+           ON CONFLICT (room_id) DO UPDATE SET spec=excluded.spec, group_size=excluded.group_size,
+                                               planned_at=excluded.planned_at, run_at=excluded.run_at""",
+        *scheduled,
+    )
+
+async def claim_next_run(db: Database, scheduled: ScheduledRound, planned_at: int, run_at: int) -> bool:
+    """Move a due schedule on to its next run. False if something else already did."""
+    claimed = await db.fetchval(
+        """UPDATE donut_schedule SET planned_at=$3, run_at=$4
+           WHERE room_id=$1 AND run_at=$2 RETURNING room_id""",
+        scheduled.room_id, scheduled.run_at, planned_at, run_at,
+    )
+    return claimed is not None
+
+async def delete_schedule(db: Database, room_id: RoomID) -> None:
+    await db.execute("DELETE FROM donut_schedule WHERE room_id=$1", room_id)
@@ -0,0 +1,26 @@
+from typing import FrozenSet, List, NamedTuple, NewType, Optional, Set
+
+from mautrix.types.util.obj import Lst
+
+class SimpleMember(NamedTuple):
+    # None when not looked up; only filled in for formatting
+    display_name: Optional[str]
+    mxid: str
+
+Donut = NewType("Donut", Set[FrozenSet[SimpleMember]])
+
+# A donut as plain data: the mxids of every group. Display names aren't stored.
+Round = List[List[str]]
+
+def _json_to_donut(jsonDonut: Lst) -> Donut:
+    newDonut = Donut(set())
+    for jsonGroup in jsonDonut:
+        newGroup: Set[SimpleMember] = set()
+        for jsonMember in jsonGroup:
+            newMember = SimpleMember(jsonMember.display_name, jsonMember.mxid)
+            newGroup.add(newMember)
+        newDonut.add(frozenset(newGroup))
+    return newDonut
+
+def _donut_to_round(donut: Donut) -> Round:
+    return [[m.mxid for m in group] for group in donut]
@@ -0,0 +1,70 @@
+from html import escape
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from mautrix.types import Format, MessageType, TextMessageEventContent
+from mautrix.util import markdown
+
+from .donut import Donut, SimpleMember
+
+MATRIX_TO = "https://matrix.to/#/"
+# Body and HTML together, leaving room in the homeserver's 64 KiB event limit
+MAX_MESSAGE_BYTES = 30000
+
+# A line of output as plain text and, when formatting, as HTML
+Line = Tuple[str, Optional[str]]
+
+def member_name(member: SimpleMember) -> str:
+    return member.display_name if member.display_name else member.mxid
+
+def member_pill(member: SimpleMember) -> str:
+    return f'<a href="{MATRIX_TO}{escape(member.mxid)}">{escape(member_name(member))}</a>'
+
+def group_line(group: Iterable[SimpleMember], html: bool) -> Line:
+    group = list(group)
+    plain = ", ".join(member_name(m) for m in group)
+    return plain, ", ".join(member_pill(m) for m in group) if html else None
+
+def donut_lines(donut: Donut, html: bool) -> List[Line]:
+    return [group_line(group, html) for group in donut]
+
+def member_lines(members: Iterable[SimpleMember], html: bool) -> List[Line]:
+    return [(member_name(m), member_pill(m) if html else None) for m in members]
+
+def render(header: str, lines: Sequence[Line], max_bytes: int) -> List[TextMessageEventContent]:
+    """Turn ``lines`` into as few messages as fit in ``max_bytes`` each.
+
+    ``header`` is Markdown and only goes on the first message. Every line is
+    formatted once and every message joined once, so this stays linear in the
+    size of the output. A single line longer than ``max_bytes`` still gets a
+    message of its own.
+    """
+    html = any(h is not None for _, h in lines)
+    html_header = markdown.render(header).strip() if html else ""
+    overhead = len("<ul></ul>") if html else 0
+    size = overhead + _size(header) + _size(html_header)
+    chunks: List[List[Tuple[str, str]]] = [[]]
+    for plain, formatted in lines:
+        item = (f" - {plain}\n", f"<li>{formatted}</li>" if html else "")
+        item_size = _size(item[0]) + _size(item[1])
+        if chunks[-1] and size + item_size > max_bytes:
+            chunks.append([])
+            size = overhead
+        chunks[-1].append(item)
+        size += item_size
+    return [_message(header if i == 0 else "", html_header if i == 0 else "", chunk, html)
+            for i, chunk in enumerate(chunks)]
+
+def _size(s: str) -> int:
+    return len(s.encode("utf-8"))
+
+def _message(header: str, html_header: str, items: List[Tuple[str, str]], html: bool) -> TextMessageEventContent:
+    body = "".join([header + "\n" if header else ""] + [plain for plain, _ in items])
+    content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=body.rstrip("\n"))
+    if html:
+        content.format = Format.HTML
+        content.formatted_body = "".join([html_header, "<ul>" if items else ""]
+                                         + [formatted for _, formatted in items]
+                                         + ["</ul>" if items else ""])
+    # Pills are only there to show who's who, so nobody gets pinged by a list
+    content["m.mentions"] = {}
+    return content
@@ -0,0 +1,153 @@
+import random
+import time
+from math import floor
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+# Members are ids from an interning.MemberTable. Costs are kept integral so the
+# running group totals don't drift
+PairCost = Callable[[int, int], int]
+
+class RepairedGroup(NamedTuple):
+    members: List[int]
+    # Index of the old group this one grew out of, None for a brand-new group
+    origin: Optional[int]
+
+# How many unmatched members the greedy pairing looks at before settling
+PAIRING_WINDOW = 64
+# Local search iterations between deadline checks
+CHECK_EVERY = 256
+# The search gives up after this many checks in a row without a lower total
+STALL_CHECKS = 20
+
+def group_sizes(member_count: int, group_size: int) -> List[int]:
+    """Sizes of the groups for a round, using the same rule as _generate_donut.
+
+    A remainder of at most half a group is folded into the last full group,
+    anything bigger becomes a smaller group of its own.
+    """
+    if member_count <= 0:
+        return []
+    full, rest = divmod(member_count, group_size)
+    if rest == 0:
+        return [group_size] * full
+    if full > 0 and rest <= floor(group_size / 2):
+        return [group_size] * (full - 1) + [group_size + rest]
+    return [group_size] * full + [rest]
+
+def assign_groups(members: Sequence[int],
+                  group_size: int,
+                  cost: PairCost,
+                  time_budget: float,
+                  rng: Optional[random.Random] = None) -> List[List[int]]:
+    """Split ``members`` into groups that keep the total pair ``cost`` low.
+
+    Pairs start from a greedy low-cost matching, bigger groups from a shuffle.
+    Then members are swapped between groups as long as that lowers (or doesn't
+    raise) the total, until it reaches zero, stops going down or ``time_budget``
+    seconds are used.
+    """
+    deadline = time.monotonic() + time_budget
+    rng = rng or random.Random()
+    order = list(members)
+    rng.shuffle(order)
+    if group_size == 2:
+        order = _greedy_pairs(order, cost)
+    groups: List[List[int]] = []
+    start = 0
+    for size in group_sizes(len(order), group_size):
+        groups.append(order[start:start + size])
+        start += size
+    if len(groups) < 2:
+        return groups
+
+    group_costs = [_group_cost(group, cost) for group in groups]
+    # No swap raises the total, so the groups as they are always are the best seen
+    best = sum(group_costs)
+    stalled = 0
+    while time.monotonic() < deadline and stalled < STALL_CHECKS:
+        hot = [gi for gi, c in enumerate(group_costs) if c > 0]
+        if not hot:
+            break
+        for _ in range(CHECK_EVERY):
+            g = rng.choice(hot)
+            if group_costs[g] <= 0:
+                continue
+            h = rng.randrange(len(groups) - 1)
+            if h >= g:
+                h += 1
+            xi = rng.randrange(len(groups[g]))
+            yi = rng.randrange(len(groups[h]))
+            x, y = groups[g][xi], groups[h][yi]
+            x_old = _cost_to(x, groups[g], cost)
+            y_old = _cost_to(y, groups[h], cost)
+            x_new = _cost_to(x, groups[h], cost, skip=y)
+            y_new = _cost_to(y, groups[g], cost, skip=x)
+            delta = (x_new + y_new) - (x_old + y_old)
+            # Sideways moves let the search walk across plateaus
+            if delta < 0 or (delta == 0 and rng.random() < 0.1):
+                groups[g][xi], groups[h][yi] = y, x
+                group_costs[g] += y_new - x_old
+                group_costs[h] += x_new - y_old
+        total = sum(group_costs)
+        if total < best:
+            best, stalled = total, 0
+        else:
+            stalled += 1
+    return groups
+
+def repair_groups(groups: Sequence[Sequence[int]],
+                  members: Sequence[int],
+                  group_size: int,
+                  cost: PairCost) -> List[RepairedGroup]:
+    """Fit an existing round to the current ``members``, moving as few people as possible.
+
+    Members who left are dropped from their groups. Anyone left alone by that, and
+    everyone who isn't in a group yet, is placed again: as many full new groups of
+    ``group_size`` as they make up, and the rest by the same rule as group_sizes.
+    More than half a group becomes a group of its own, anything less goes one by
+    one into the smallest group where they've met the fewest people. Groups that
+    end up empty are gone.
+    """
+    present = set(members)
+    repaired = [RepairedGroup([m for m in group if m in present], i) for i, group in enumerate(groups)]
+    grouped = {m for group in repaired for m in group.members}
+    homeless = [m for m in members if m not in grouped]
+    for group in repaired:
+        if len(group.members) == 1:
+            homeless += group.members
+    repaired = [group for group in repaired if len(group.members) > 1]
+    full = len(homeless) // group_size if group_size > 0 else 0
+    for i in range(full):
+        repaired.append(RepairedGroup(homeless[i * group_size:(i + 1) * group_size], None))
+    rest = homeless[full * group_size:]
+    if rest and (not repaired or len(rest) > floor(group_size / 2)):
+        repaired.append(RepairedGroup(rest, None))
+        rest = []
+    for member in rest:
+        best = min(repaired, key=lambda g: (len(g.members), _cost_to(member, g.members, cost)))
+        best.members.append(member)
+    return repaired
+
+def _greedy_pairs(order: List[int], cost: PairCost) -> List[int]:
+    remaining = list(order)
+    paired: List[int] = []
+    while len(remaining) >= 2:
+        a = remaining.pop()
+        best_i, best_cost = len(remaining) - 1, None
+        for i in range(len(remaining) - 1, max(len(remaining) - 1 - PAIRING_WINDOW, -1), -1):
+            c = cost(a, remaining[i])
+            if best_cost is None or c < best_cost:
+                best_i, best_cost = i, c
+                if c == 0:
+                    break
+        remaining[best_i], remaining[-1] = remaining[-1], remaining[best_i]
+        paired += [a, remaining.pop()]
+    return paired + remaining
+
+def _group_cost(group: Sequence[int], cost: PairCost) -> int:
+    return sum(cost(group[i], group[j])
+               for i in range(len(group))
+               for j in range(i + 1, len(group)))
+
+def _cost_to(member: int, group: Sequence[int], cost: PairCost, skip: Optional[int] = None) -> int:
+    return sum(cost(member, other) for other in group if other != member and other != skip)
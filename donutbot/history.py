@@ -0,0 +1,107 @@
+from itertools import combinations
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .interning import Group, id_pair
+
+# A round as interned groups, unlike donut.Round which holds mxids
+IdRound = List[Group]
+
+class PairStats(NamedTuple):
+    times: int
+    last_round: int
+
+class RoundIndex:
+    """Which group of one round each member was in.
+
+    Another round's groups are checked against it one member at a time, bucketing
+    each group's members by their old group, so the work is linear in the number
+    of members. That catches partial overlap too, like a group of three where two
+    were grouped before, which comparing whole groups can't.
+    """
+
+    def __init__(self, groups: Iterable[Iterable[int]] = ()) -> None:
+        self.group_of: Dict[int, int] = {}
+        for i, group in enumerate(groups):
+            for member in group:
+                self.group_of[member] = i
+
+    def shared_pairs(self, groups: Iterable[Iterable[int]]) -> int:
+        """How many pairs in ``groups`` were in the same group this round."""
+        group_of = self.group_of
+        shared = 0
+        for group in groups:
+            seen: Dict[int, int] = {}
+            for member in group:
+                old = group_of.get(member)
+                if old is not None:
+                    # One pair with each member already seen from the same old group
+                    count = seen.get(old, 0)
+                    shared += count
+                    seen[old] = count + 1
+        return shared
+
+class PairingHistory:
+    """Every past round for a room, plus an index of who has been grouped with whom.
+
+    Rounds are numbered from 0 in the order they were added and hold members as
+    ids from the room's interning.MemberTable. ``pairs`` maps each pair of ids
+    (sorted) to how often they shared a group and the last round they did, so pair
+    lookups don't need to scan old rounds. ``latest`` indexes the newest round.
+    """
+
+    def __init__(self, rounds: Iterable[Iterable[Iterable[int]]] = ()) -> None:
+        self.rounds: List[IdRound] = []
+        self.pairs: Dict[Tuple[int, int], PairStats] = {}
+        self.latest = RoundIndex()
+        for groups in rounds:
+            self.add_round(groups)
+
+    def __len__(self) -> int:
+        return len(self.rounds)
+
+    def add_round(self, groups: Iterable[Iterable[int]]) -> int:
+        round_no = len(self.rounds)
+        new_round = [tuple(sorted(group)) for group in groups]
+        self.rounds.append(new_round)
+        for group in new_round:
+            for a, b in combinations(group, 2):
+                old = self.pairs.get((a, b))
+                self.pairs[(a, b)] = PairStats(times=old.times + 1 if old else 1, last_round=round_no)
+        self.latest = RoundIndex(new_round)
+        return round_no
+
+    def pair(self, a: int, b: int) -> Optional[PairStats]:
+        return self.pairs.get(id_pair(a, b))
+
+    def met_since(self, a: int, b: int, since_round: int) -> bool:
+        stats = self.pair(a, b)
+        return stats is not None and stats.last_round >= since_round
+
+    def repeat_cost(self, a: int, b: int, recent_rounds: int) -> int:
+        """How bad it would be to group ``a`` and ``b`` in the next round.
+
+        Every earlier meeting costs 1, and meeting within the last ``recent_rounds``
+        rounds adds a much larger penalty that shrinks the longer ago it was.
+        """
+        stats = self.pair(a, b)
+        if stats is None:
+            return 0
+        rounds_ago = len(self.rounds) - stats.last_round
+        if rounds_ago <= recent_rounds:
+            return stats.times + 100 // rounds_ago
+        return stats.times
+
+    def pair_costs(self, members: Iterable[int], recent_rounds: int) -> Dict[Tuple[int, int], int]:
+        """repeat_cost for every pair of ``members`` that has met, keyed by id_pair."""
+        present = set(members)
+        return {(a, b): self.repeat_cost(a, b, recent_rounds)
+                for a, b in self.pairs if a in present and b in present}
+
+    def repeat_pairs(self, groups: Iterable[Iterable[int]], since_round: int = 0) -> int:
+        """Count pairs in ``groups`` that already shared a group in or after ``since_round``."""
+        if since_round == len(self.rounds) - 1:
+            # Only the newest round counts, which its index answers without pair lookups
+            return self.latest.shared_pairs(groups)
+        return sum(1 for group in groups
+                   for a, b in combinations(group, 2)
+                   if self.met_since(a, b, since_round))
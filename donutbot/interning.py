@@ -0,0 +1,51 @@
+from typing import Dict, Iterable, List, Tuple
+
+from .donut import Donut, Round, SimpleMember
+
+# A group as the sorted ids of its members
+Group = Tuple[int, ...]
+
+def id_pair(a: int, b: int) -> Tuple[int, int]:
+    return (a, b) if a < b else (b, a)
+
+class MemberTable:
+    """Dense int ids for the mxids of one room.
+
+    Ids are handed out in order of first use and never change, so interned groups
+    stay valid however people come and go. The grouping core only sees ids;
+    mxids and SimpleMembers come back at the edges, to format or persist a round.
+    """
+
+    def __init__(self, mxids: Iterable[str] = ()) -> None:
+        self.mxids: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for mxid in mxids:
+            self.intern(mxid)
+
+    def __len__(self) -> int:
+        return len(self.mxids)
+
+    def intern(self, mxid: str) -> int:
+        i = self.ids.get(mxid)
+        if i is None:
+            i = self.ids[mxid] = len(self.mxids)
+            self.mxids.append(mxid)
+        return i
+
+    def group(self, mxids: Iterable[str]) -> Group:
+        return tuple(sorted(self.intern(mxid) for mxid in mxids))
+
+    def groups(self, donut_round: Iterable[Iterable[str]]) -> List[Group]:
+        return [self.group(group) for group in donut_round]
+
+    def from_donut(self, donut: Donut) -> List[Group]:
+        return [self.group(m.mxid for m in group) for group in donut]
+
+    def to_round(self, groups: Iterable[Group]) -> Round:
+        mxids = self.mxids
+        return [[mxids[i] for i in group] for group in groups]
+
+    def to_donut(self, groups: Iterable[Group]) -> Donut:
+        mxids = self.mxids
+        return Donut({frozenset(SimpleMember(display_name=None, mxid=mxids[i]) for i in group)
+                      for group in groups})
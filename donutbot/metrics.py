@@ -0,0 +1,139 @@
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+# Seconds. Confirming a big room can take minutes, so the top goes well past the usual 10s.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if not self.labels and not self.values:
+            self.values[()] = 0
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: the count in each bucket (not cumulative), then sum and count
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = dict()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts, total, count = self.values.get(label_values) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.values[label_values] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _labels(self.labels + ("le",), label_values + (_number(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {count}")
+        return lines
+
+class Metrics:
+    """Everything the plugin measures, rendered in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.command_seconds = Histogram("donutbot_command_seconds",
+                                         "Time spent handling a !donut subcommand", ("command",))
+        self.client_seconds = Histogram("donutbot_client_call_seconds",
+                                        "Time spent in a homeserver call, by client method", ("method",))
+        self.client_errors = Counter("donutbot_client_errors_total",
+                                     "Homeserver calls that raised, by client method", ("method",))
+        self.retries = Counter("donutbot_retries_total",
+                               "Homeserver calls retried after being rate limited", ("method",))
+        self.rooms_created = Counter("donutbot_rooms_created_total", "DONUT rooms set up")
+        self.room_failures = Counter("donutbot_room_failures_total", "DONUT rooms that could not be set up")
+        self.rooms_reused = Counter("donutbot_rooms_reused_total",
+                                    "DONUT rooms set up by going back to a repeat group's old room")
+        self.rooms_left = Counter("donutbot_rooms_left_total", "Unused DONUT rooms the bot left")
+        self.spare_rooms_created = Counter("donutbot_spare_rooms_created_total",
+                                           "Empty rooms created ahead of time for the room pool")
+        self.spare_rooms_used = Counter("donutbot_spare_rooms_used_total",
+                                        "DONUT rooms set up with a room from the pool")
+
+    def render(self) -> str:
+        metrics = (self.command_seconds, self.client_seconds, self.client_errors,
+                   self.retries, self.rooms_created, self.room_failures, self.rooms_reused,
+                   self.rooms_left, self.spare_rooms_created, self.spare_rooms_used)
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+class InstrumentedClient:
+    """Wraps a client so every async method call is timed and its errors counted.
+
+    Everything else (like ``mxid``) is passed through unchanged.
+    """
+
+    def __init__(self, client: Any, metrics: Metrics) -> None:
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+        metrics = self._metrics
+        @functools.wraps(attr)
+        async def call(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception:
+                metrics.client_errors.inc(name)
+                raise
+            finally:
+                metrics.client_seconds.observe(time.perf_counter() - started, name)
+        return call
+
+def timed(command: str) -> Callable[[F], F]:
+    """Record how long a DonutBot command handler takes in ``command_seconds``."""
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        async def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await fn(self, *args, **kwargs)
+            finally:
+                self.metrics.command_seconds.observe(time.perf_counter() - started, command)
+        return wrapper # type: ignore
+    return decorator
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import random
+import time
+from logging import warn
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, TypeVar
+
+from mautrix.errors.request import MatrixRequestError, MLimitExceeded
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+class RateLimiter:
+    """Token bucket for homeserver calls that slows down when it gets rate limited.
+
+    Every call takes a token. On M_LIMIT_EXCEEDED the bucket is emptied, all callers
+    wait for the server's ``retry_after_ms`` (or an exponential backoff if the server
+    didn't send one), and the refill rate is halved. Each success then gives back a
+    tenth of the configured rate until it is back to full speed.
+
+    ``on_retry`` is called with the name of the function whenever a call is retried.
+    """
+
+    def __init__(self, rate: float, burst: int, max_retries: int,
+                 on_retry: Optional[Callable[[str], None]] = None) -> None:
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_retries = max_retries
+        self.on_retry = on_retry
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # The lock makes waiters queue up in order instead of all waking at once
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, retry_after: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.tokens = 0
+        self.updated = self.blocked_until
+        self.rate = max(self.rate / 2, self.min_rate)
+
+    def recover(self) -> None:
+        self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+
+    async def call(self, fn: Callable[..., Awaitable[R]], *args: Any, **kwargs: Any) -> R:
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                result = await fn(*args, **kwargs)
+            except MatrixRequestError as e:
+                if not _is_rate_limited(e) or attempt >= self.max_retries:
+                    raise
+                retry_after = _retry_after(e)
+                if retry_after is None:
+                    retry_after = min(2 ** attempt, 60) * (1 + random.random() / 2)
+                warn(f"Rate limited on {fn.__name__}, retrying in {retry_after:.1f}s")
+                self.throttle(retry_after)
+                if self.on_retry:
+                    self.on_retry(fn.__name__)
+                attempt += 1
+                continue
+            self.recover()
+            return result
+
+async def run_bounded(items: Sequence[T],
+                      fn: Callable[[T], Awaitable[Any]],
+                      concurrency: int,
+                      on_progress: Optional[ProgressCallback] = None) -> List[Optional[Exception]]:
+    """Run ``fn`` over ``items`` with at most ``concurrency`` in flight.
+
+    A failure doesn't stop the other items, and neither does one of
+    ``on_progress``, which is only logged. Returns the exception raised for each
+    item (or None if it succeeded), in the same order as ``items``.
+    """
+    errors: List[Optional[Exception]] = [None] * len(items)
+    pending = iter(range(len(items)))
+    done = 0
+
+    async def worker() -> None:
+        nonlocal done
+        for i in pending:
+            try:
+                await fn(items[i])
+            except Exception as e:
+                errors[i] = e
+            done += 1
+            if on_progress:
+                try:
+                    await on_progress(done, len(items))
+                except Exception as e:
+                    # Only the report failed; the worker has more items to do
+                    warn(f"Error reporting progress: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(max(min(concurrency, len(items)), 1))))
+    return errors
+
+def _is_rate_limited(e: MatrixRequestError) -> bool:
+    return isinstance(e, MLimitExceeded) or getattr(e, "http_status", None) == 429
+
+def _retry_after(e: MatrixRequestError) -> Optional[float]:
+    retry_after_ms = getattr(e, "retry_after_ms", None)
+    text = getattr(e, "text", None)
+    if retry_after_ms is None and text:
+        try:
+            retry_after_ms = json.loads(text).get("retry_after_ms")
+        except (ValueError, AttributeError):
+            pass
+    if isinstance(retry_after_ms, (int, float)):
+        return retry_after_ms / 1000
+    return None
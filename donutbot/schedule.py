@@ -0,0 +1,129 @@
+import re
+from datetime import datetime, timedelta, tzinfo
+from typing import List, NamedTuple, Optional, Set, Tuple
+
+# How far ahead a cron expression is searched for its next match
+MAX_SEARCH_DAYS = 366 * 5
+
+SHORTHANDS = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+}
+INTERVAL_UNITS = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+class Cron(NamedTuple):
+    minutes: Set[int]
+    hours: Set[int]
+    days: Set[int]
+    months: Set[int]
+    weekdays: Set[int]
+    # Whether the day of month and day of week fields were given. Like cron, when
+    # both are, a day matches if either does.
+    days_restricted: bool
+    weekdays_restricted: bool
+
+class Schedule:
+    """When recurring DONUTs happen, parsed from a cron-like spec.
+
+    Either a five-field cron expression (minute hour day-of-month month
+    day-of-week, with ``*``, lists, ranges and ``/`` steps), one of the @hourly,
+    @daily, @weekly, @monthly or @yearly shorthands, or ``@every <n><m|h|d|w>``.
+    An ``@every`` schedule counts from the previous planned run, so ``@every 2w``
+    keeps the weekday and time of the first one.
+    """
+
+    def __init__(self, spec: str) -> None:
+        self.spec = " ".join(spec.split())
+        self.interval: Optional[timedelta] = None
+        self.cron: Optional[Cron] = None
+        expression = SHORTHANDS.get(self.spec.lower(), self.spec)
+        match = re.fullmatch(r"@every\s+(\d+)\s*([mhdw])", expression, re.IGNORECASE)
+        if match:
+            seconds = int(match.group(1)) * INTERVAL_UNITS[match.group(2).lower()]
+            if seconds <= 0:
+                raise ValueError("The interval has to be longer than 0")
+            self.interval = timedelta(seconds=seconds)
+        else:
+            self.cron = _parse_cron(expression)
+
+    def next_after(self, previous: Optional[datetime], now: datetime) -> datetime:
+        """The first run after ``now``. ``previous`` is the last planned run, if any."""
+        if self.interval is not None:
+            if previous is None:
+                return now + self.interval
+            # Skip runs that were missed rather than catching up on all of them
+            missed = max((now - previous) // self.interval, 0)
+            return previous + self.interval * (missed + 1)
+        assert self.cron is not None
+        return _next_cron(self.cron, now)
+
+    def __str__(self) -> str:
+        return self.spec
+
+def _parse_cron(expression: str) -> Cron:
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError("A cron expression has five fields: minute hour day-of-month month day-of-week")
+    minutes = _parse_field(fields[0], 0, 59)
+    hours = _parse_field(fields[1], 0, 23)
+    days = _parse_field(fields[2], 1, 31)
+    months = _parse_field(fields[3], 1, 12)
+    # 7 is Sunday too
+    weekdays = {d % 7 for d in _parse_field(fields[4], 0, 7)}
+    return Cron(minutes, hours, days, months, weekdays,
+                days_restricted=fields[2] != "*", weekdays_restricted=fields[4] != "*")
+
+def _parse_field(field: str, low: int, high: int) -> Set[int]:
+    values: Set[int] = set()
+    for part in field.split(","):
+        match = re.fullmatch(r"(\*|(\d+)(?:-(\d+))?)(?:/(\d+))?", part)
+        if not match:
+            raise ValueError(f"Can't parse {part!r}")
+        if match.group(1) == "*":
+            start, end = low, high
+        else:
+            start = int(match.group(2))
+            # A step after a single value runs to the end of the range, like cron
+            end = int(match.group(3)) if match.group(3) else (high if match.group(4) else start)
+        step = int(match.group(4)) if match.group(4) else 1
+        if not (low <= start <= end <= high) or step <= 0:
+            raise ValueError(f"{part!r} is out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def _next_cron(cron: Cron, now: datetime) -> datetime:
+    start = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day = start.replace(hour=0, minute=0)
+    for _ in range(MAX_SEARCH_DAYS):
+        if day.month in cron.months and _day_matches(cron, day):
+            for hour, minute in _times(cron):
+                candidate = day.replace(hour=hour, minute=minute)
+                if candidate >= start:
+                    return candidate
+        day = _next_day(day)
+    raise ValueError("The schedule never matches")
+
+def _day_matches(cron: Cron, day: datetime) -> bool:
+    # datetime counts weekdays from Monday, cron from Sunday
+    day_ok = day.day in cron.days
+    weekday_ok = (day.weekday() + 1) % 7 in cron.weekdays
+    if cron.days_restricted and cron.weekdays_restricted:
+        return day_ok or weekday_ok
+    return day_ok and weekday_ok
+
+def _times(cron: Cron) -> List[Tuple[int, int]]:
+    return [(h, m) for h in sorted(cron.hours) for m in sorted(cron.minutes)]
+
+def _next_day(day: datetime) -> datetime:
+    # Going through the date keeps this right across DST changes in aware datetimes
+    following = day.date() + timedelta(days=1)
+    return day.replace(year=following.year, month=following.month, day=following.day)
+
+def localize(timestamp_ms: int, tz: tzinfo) -> datetime:
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz)
+
+def to_ms(when: datetime) -> int:
+    return int(when.timestamp() * 1000)
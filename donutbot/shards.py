@@ -0,0 +1,82 @@
+import base64
+import hashlib
+import json
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+# Shards are named by the stream they hold and their position in it
+STREAMS = ("members", "history")
+# When compressing, assume at least this ratio when packing and check afterwards
+COMPRESSION_GUESS = 3
+
+def split_state(data: Dict[str, Any], compress: bool, max_bytes: int) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """Split version 2 state data into a manifest and shard contents keyed by state key.
+
+    The member table and the groups of every round (oldest first) are each packed
+    greedily into shards of at most ``max_bytes``. Both only ever grow at the end,
+    so after a new round is added only the last shards of each stream change.
+    """
+    items = {
+        "members": data["members"],
+        "history": [group for r in data["history"] for group in r],
+    }
+    shards: Dict[str, Dict[str, Any]] = dict()
+    for stream in STREAMS:
+        shards.update(_pack_stream(stream, items[stream], compress, max_bytes))
+    manifest = {
+        "rounds": [len(r) for r in data["history"]],
+        "shards": {key: shard_hash(content) for key, content in shards.items()},
+    }
+    return manifest, shards
+
+def join_state(manifest: Dict[str, Any], shards: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    items: Dict[str, List[Any]] = {stream: list() for stream in STREAMS}
+    for key in _ordered_keys(manifest["shards"]):
+        items[key.split(".")[0]].extend(_unpack_items(shards[key]))
+    history: List[List[Any]] = list()
+    groups = iter(items["history"])
+    for group_count in manifest["rounds"]:
+        history.append([next(groups) for _ in range(group_count)])
+    return {"members": items["members"], "history": history}
+
+def changed_shards(old_manifest: Optional[Dict[str, Any]], new_manifest: Dict[str, Any],
+                   shards: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    old_hashes = (old_manifest or {}).get("shards") or {}
+    return {key: content for key, content in shards.items()
+            if old_hashes.get(key) != new_manifest["shards"][key]}
+
+def _pack_stream(stream: str, items: List[Any], compress: bool, max_bytes: int) -> Dict[str, Dict[str, Any]]:
+    budget = max_bytes * COMPRESSION_GUESS if compress else max_bytes
+    while True:
+        chunks: List[List[Any]] = [[]]
+        size = 0
+        for item in items:
+            item_size = len(json.dumps(item, separators=(",", ":"))) + 1
+            if chunks[-1] and size + item_size > budget:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(item)
+            size += item_size
+        contents = [_pack_items(chunk, compress) for chunk in chunks if chunk]
+        # A single item bigger than the budget can't be split any further
+        if (budget <= max_bytes // 4
+                or all(len(json.dumps(c)) <= max_bytes for c in contents)):
+            return {f"{stream}.{i}": content for i, content in enumerate(contents)}
+        budget //= 2
+
+def _pack_items(items: List[Any], compress: bool) -> Dict[str, Any]:
+    if compress:
+        packed = zlib.compress(json.dumps(items, separators=(",", ":")).encode("utf-8"), 9)
+        return {"encoding": "zlib", "data": base64.b64encode(packed).decode("ascii")}
+    return {"items": items}
+
+def _unpack_items(content: Dict[str, Any]) -> List[Any]:
+    if content.get("encoding") == "zlib":
+        return json.loads(zlib.decompress(base64.b64decode(content["data"])))
+    return content["items"]
+
+def shard_hash(content: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def _ordered_keys(keys: Any) -> List[str]:
+    return sorted(keys, key=lambda k: (STREAMS.index(k.split(".")[0]), int(k.split(".")[1])))
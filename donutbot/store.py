@@ -0,0 +1,306 @@
+import asyncio
+import base64
+import json
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from mautrix.client import Client
+from mautrix.errors.request import MNotFound
+from mautrix.types.event.state import StateEvent, StateEventContent
+from mautrix.types.event.type import EventType
+from mautrix.types.primitive import RoomID
+from mautrix.types.util.obj import Obj
+from mautrix.util.async_db import Database
+
+from . import db
+from .db import Partner
+from .donut import Round, _donut_to_round, _json_to_donut
+from .ratelimit import RateLimiter, run_bounded
+from .shards import changed_shards, join_state, shard_hash, split_state
+
+donut_state_event = EventType.find("net.hyperflux.donutbot.donut_state",
+                                   t_class=EventType.Class.STATE)
+
+# Version 1 (no "version" key) stores every member as a {display_name, mxid} object.
+# Version 2 stores a "members" table of [mxid, display_name] and every group as a list
+# of indices into it, optionally zlib-compressed and base64-encoded into "data".
+# When that doesn't fit in one event, the "" state key holds a manifest ("sharded")
+# and the member table and history are spread over numbered state keys.
+# Version 3 is version 2 with only mxids in the member table, so names can't go stale
+# and the table really only grows at the end.
+STATE_VERSION = 3
+READABLE_VERSIONS = (2, 3)
+STATE_KEYS = ("version", "encoding", "data", "members", "current_donut", "last_donut", "history",
+              "sharded", "rounds", "shards")
+
+class DonutStore(ABC):
+    """Where the rounds of each room are kept.
+
+    Rounds are numbered from 0 in the order they were added. Every method works on
+    a batch of rooms so backends can read and write them in one go.
+    """
+
+    # Whether rounds keep the time they were added, so get_partners' since works
+    records_times = True
+
+    @abstractmethod
+    async def load(self, room_ids: Sequence[RoomID]) -> Dict[RoomID, List[Round]]:
+        """All rounds of each room, oldest first. Rooms without any get an empty list."""
+
+    @abstractmethod
+    async def append(self, rounds: Dict[RoomID, Round], created_at: int) -> None:
+        """Add one new round to each room."""
+
+    @abstractmethod
+    async def replace(self, histories: Dict[RoomID, List[Round]]) -> None:
+        """Overwrite the whole history of each room. Rounds that didn't change keep their time."""
+
+    @abstractmethod
+    async def replace_latest(self, rounds: Dict[RoomID, Round]) -> None:
+        """Overwrite the latest round of each room, e.g. after repairing it. Rooms without rounds are skipped."""
+
+    @abstractmethod
+    async def get_partners(self, room_id: RoomID, user_id: str, since: int) -> List[Partner]:
+        """Everyone who shared a group with ``user_id`` in a round from ``since`` (ms) on.
+
+        Rounds whose time isn't known always count, with a created_at of None.
+        """
+
+class MemoryDonutStore(DonutStore):
+    """Keeps everything in a dict. Nothing survives a restart."""
+
+    def __init__(self) -> None:
+        self.rooms: Dict[RoomID, List[Tuple[Optional[int], Round]]] = dict()
+
+    async def load(self, room_ids: Sequence[RoomID]) -> Dict[RoomID, List[Round]]:
+        return {room_id: [r for _, r in self.rooms.get(room_id, [])] for room_id in room_ids}
+
+    async def append(self, rounds: Dict[RoomID, Round], created_at: int) -> None:
+        for room_id, new_round in rounds.items():
+            self.rooms.setdefault(room_id, []).append((created_at, new_round))
+
+    async def replace(self, histories: Dict[RoomID, List[Round]]) -> None:
+        for room_id, rounds in histories.items():
+            old = self.rooms.get(room_id, [])
+            self.rooms[room_id] = [(old[i][0] if i < len(old) and _same_groups(old[i][1], r) else None, r)
+                                   for i, r in enumerate(rounds)]
+
+    async def replace_latest(self, rounds: Dict[RoomID, Round]) -> None:
+        for room_id, new_round in rounds.items():
+            room_rounds = self.rooms.get(room_id)
+            if room_rounds:
+                room_rounds[-1] = (room_rounds[-1][0], new_round)
+
+    async def get_partners(self, room_id: RoomID, user_id: str, since: int) -> List[Partner]:
+        return _partners(enumerate(self.rooms.get(room_id, [])), user_id, since)
+
+class DatabaseDonutStore(DonutStore):
+    """Keeps rounds in the plugin database (SQLite or Postgres, whatever maubot uses)."""
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def load(self, room_ids: Sequence[RoomID]) -> Dict[RoomID, List[Round]]:
+        return await db.get_rounds(self.database, room_ids)
+
+    async def append(self, rounds: Dict[RoomID, Round], created_at: int) -> None:
+        await db.add_rounds(self.database, rounds, created_at)
+
+    async def replace(self, histories: Dict[RoomID, List[Round]]) -> None:
+        await db.replace_rounds(self.database, histories)
+
+    async def replace_latest(self, rounds: Dict[RoomID, Round]) -> None:
+        await db.replace_latest_rounds(self.database, rounds)
+
+    async def get_partners(self, room_id: RoomID, user_id: str, since: int) -> List[Partner]:
+        return await db.get_partners(self.database, room_id, user_id, since)
+
+class StateEventDonutStore(DonutStore):
+    """Keeps rounds in the room's donut_state event(s). This is the source of truth."""
+
+    records_times = False
+
+    def __init__(self, client: Client, limiter: RateLimiter, compress: bool,
+                 max_event_bytes: int, concurrency: int) -> None:
+        self.client = client
+        self.limiter = limiter
+        self.compress = compress
+        self.max_event_bytes = max_event_bytes
+        self.concurrency = concurrency
+        # The donut_state event of each room. A room that is present with a value of
+        # None is known to have no donut state yet.
+        self.states: Dict[RoomID, Optional[StateEventContent]] = dict()
+        # Decoded rounds of each room, so the state is only parsed once per change
+        self.rounds: Dict[RoomID, List[Round]] = dict()
+        # Hashes of the events being written to each room by state key. They're noted
+        # before anything is sent, so echoes that come back mid-write are known.
+        self.pending: Dict[RoomID, Dict[str, str]] = dict()
+
+    async def load(self, room_ids: Sequence[RoomID]) -> Dict[RoomID, List[Round]]:
+        loaded = await asyncio.gather(*(self._load_room(room_id) for room_id in room_ids))
+        return dict(zip(room_ids, loaded))
+
+    async def append(self, rounds: Dict[RoomID, Round], created_at: int) -> None:
+        async def append_room(room_id: RoomID, new_round: Round) -> None:
+            await self._write_room(room_id, await self._load_room(room_id) + [new_round])
+        await asyncio.gather(*(append_room(room_id, r) for room_id, r in rounds.items()))
+
+    async def replace(self, histories: Dict[RoomID, List[Round]]) -> None:
+        await asyncio.gather(*(self._write_room(room_id, rounds) for room_id, rounds in histories.items()))
+
+    async def replace_latest(self, rounds: Dict[RoomID, Round]) -> None:
+        async def replace_room(room_id: RoomID, new_round: Round) -> None:
+            old_rounds = await self._load_room(room_id)
+            if old_rounds:
+                await self._write_room(room_id, old_rounds[:-1] + [new_round])
+        await asyncio.gather(*(replace_room(room_id, r) for room_id, r in rounds.items()))
+
+    async def get_partners(self, room_id: RoomID, user_id: str, since: int) -> List[Partner]:
+        # State events don't record when a round happened, so every round counts
+        rounds = await self._load_room(room_id)
+        return _partners(((i, (None, r)) for i, r in enumerate(rounds)), user_id, since)
+
+    async def get_state(self, room_id: RoomID) -> Optional[StateEventContent]:
+        if room_id in self.states:
+            return self.states[room_id]
+        try:
+            donut_state = await self.client.get_state_event(room_id, donut_state_event)
+        except MNotFound:
+            donut_state = None
+        self.states[room_id] = donut_state
+        return donut_state
+
+    def is_own_echo(self, evt: StateEvent) -> bool:
+        pending = self.pending.get(evt.room_id, {})
+        if evt.state_key in pending and pending[evt.state_key] == shard_hash(evt.content.serialize()):
+            del pending[evt.state_key]
+            return True
+        donut_state = self.states.get(evt.room_id)
+        if not (donut_state and isinstance(donut_state, Obj)):
+            return False
+        if evt.state_key == "":
+            return donut_state.serialize() == evt.content.serialize()
+        if _is_sharded(donut_state):
+            return donut_state.shards.get(evt.state_key) == shard_hash(evt.content.serialize())
+        return False
+
+    def invalidate(self, room_id: RoomID) -> None:
+        self.states.pop(room_id, None)
+        self.rounds.pop(room_id, None)
+
+    async def _load_room(self, room_id: RoomID) -> List[Round]:
+        rounds = self.rounds.get(room_id)
+        if rounds is None:
+            donut_state = await self.get_state(room_id)
+            if _is_sharded(donut_state):
+                manifest = donut_state.serialize() # type: ignore
+                shards = await self._get_shards(room_id, list(manifest["shards"]))
+                rounds = _data_to_rounds(join_state(manifest, shards))
+            else:
+                rounds = _state_to_rounds(donut_state)
+            self.rounds[room_id] = rounds
+        return rounds
+
+    async def _write_room(self, room_id: RoomID, rounds: List[Round]) -> None:
+        old_state = await self.get_state(room_id)
+        # Keep keys we don't know about, but rebuild everything we own
+        content: Dict[str, Any] = dict()
+        if old_state and isinstance(old_state, Obj):
+            content = {k: v for k, v in old_state.serialize().items() if k not in STATE_KEYS}
+        data = _rounds_to_data(rounds)
+        packed = _pack_data(data, self.compress)
+        pending = self.pending.setdefault(room_id, dict())
+        shards_to_send: Dict[str, Dict[str, Any]] = dict()
+        if len(json.dumps(packed)) > self.max_event_bytes:
+            manifest, shards = split_state(data, self.compress, self.max_event_bytes)
+            old_manifest = old_state.serialize() if _is_sharded(old_state) else None # type: ignore
+            shards_to_send = changed_shards(old_manifest, manifest, shards)
+            pending.update((key, shard_hash(shard)) for key, shard in shards_to_send.items())
+            packed = {"version": STATE_VERSION, "sharded": True, **manifest}
+        content.update(packed)
+        donut_state = Obj(**content)
+        pending[""] = shard_hash(donut_state.serialize())
+        if shards_to_send:
+            # Shards go first so the manifest never points at shards that aren't there yet
+            await self._set_shards(room_id, shards_to_send)
+        await self.client.send_state_event(room_id=room_id,
+                                           event_type=donut_state_event,
+                                           content=donut_state)
+        self.states[room_id] = donut_state
+        self.rounds[room_id] = rounds
+
+    async def _get_shards(self, room_id: RoomID, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        contents = await asyncio.gather(*(self.client.get_state_event(room_id, donut_state_event, key)
+                                          for key in keys))
+        return {key: content.serialize() for key, content in zip(keys, contents)}
+
+    async def _set_shards(self, room_id: RoomID, shards: Dict[str, Dict[str, Any]]) -> None:
+        async def send_shard(key: str) -> None:
+            await self.limiter.call(self.client.send_state_event, room_id, donut_state_event,
+                                    Obj(**shards[key]), key)
+        errors = await run_bounded(list(shards), send_shard, concurrency=self.concurrency)
+        for e in errors:
+            if e is not None:
+                raise e
+
+def _partners(rounds: Iterable[Tuple[int, Tuple[Optional[int], Round]]], user_id: str,
+              since: int) -> List[Partner]:
+    partners: List[Partner] = list()
+    for round_no, (created_at, groups) in rounds:
+        if created_at is not None and created_at < since:
+            continue
+        for group in groups:
+            if user_id in group:
+                partners += [Partner(mxid, round_no, created_at) for mxid in group if mxid != user_id]
+    partners.reverse()
+    return partners
+
+def _same_groups(a: Round, b: Round) -> bool:
+    return {frozenset(group) for group in a} == {frozenset(group) for group in b}
+
+def _is_sharded(donut_state: Optional[StateEventContent]) -> bool:
+    return bool(donut_state and isinstance(donut_state, Obj)
+                and donut_state.get("version") in READABLE_VERSIONS and donut_state.get("sharded"))
+
+def _state_to_rounds(donut_state: Optional[StateEventContent]) -> List[Round]:
+    if not (donut_state and isinstance(donut_state, Obj)):
+        return []
+    if donut_state.get("version") in READABLE_VERSIONS:
+        data = donut_state.serialize()
+        if data.get("encoding") == "zlib":
+            data = json.loads(zlib.decompress(base64.b64decode(data["data"])))
+        return _data_to_rounds(data)
+    json_history = donut_state.get("history")
+    if json_history:
+        # Version 1 with a history of plain mxid lists
+        return [[list(group) for group in r] for r in json_history]
+    # Version 1 from before history was kept only has the last two rounds
+    return [_donut_to_round(_json_to_donut(donut_state[key]))
+            for key in ("last_donut", "current_donut") if donut_state.get(key)]
+
+def _data_to_rounds(data: Dict[str, Any]) -> List[Round]:
+    # Version 2 members are [mxid, display_name]; the names are dropped
+    members = [m if isinstance(m, str) else m[0] for m in data["members"]]
+    return [[[members[i] for i in group] for group in r] for r in data.get("history", [])]
+
+def _rounds_to_data(rounds: List[Round]) -> Dict[str, Any]:
+    # Members are numbered in order of first appearance in the history, so the table
+    # and the encoded rounds only ever grow at the end
+    member_index: Dict[str, int] = dict()
+    members: List[str] = list()
+    history: List[List[List[int]]] = list()
+    for r in rounds:
+        # Number new members by mxid so the result doesn't depend on group order
+        for mxid in sorted({mxid for group in r for mxid in group}):
+            if mxid not in member_index:
+                member_index[mxid] = len(members)
+                members.append(mxid)
+        history.append(sorted(sorted(member_index[mxid] for mxid in group) for group in r))
+    return {"members": members, "history": history}
+
+def _pack_data(data: Dict[str, Any], compress: bool) -> Dict[str, Any]:
+    if compress:
+        packed = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 9)
+        return {"version": STATE_VERSION, "encoding": "zlib", "data": base64.b64encode(packed).decode("ascii")}
+    return {"version": STATE_VERSION, **data}
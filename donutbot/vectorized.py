@@ -0,0 +1,74 @@
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .grouping import PairCost, group_sizes
+
+# Upper bound on permutation matrix elements scored at once, to keep memory flat
+MAX_BATCH_ELEMENTS = 4_000_000
+
+def available() -> bool:
+    return np is not None
+
+def cost_matrix(members: Sequence[int], pairs: Iterable[Tuple[int, int]], cost: PairCost) -> "np.ndarray":
+    """Dense member × member cost matrix, filled from the (sparse) pairs that have met."""
+    index = {member: i for i, member in enumerate(members)}
+    matrix = np.zeros((len(members), len(members)), dtype=np.int32)
+    for a, b in pairs:
+        i, j = index.get(a), index.get(b)
+        if i is not None and j is not None:
+            matrix[i, j] = matrix[j, i] = cost(a, b)
+    return matrix
+
+def best_of_random(members: Sequence[int],
+                   group_size: int,
+                   matrix: "np.ndarray",
+                   candidates: int,
+                   rng: Optional["np.random.Generator"] = None) -> List[List[int]]:
+    """Score ``candidates`` random groupings at once and return the cheapest.
+
+    Each candidate is a row of a permutation matrix. Consecutive columns form the
+    groups, using the same sizes as group_sizes, so a whole batch is scored with a
+    few fancy-indexing operations on ``matrix``.
+    """
+    rng = rng or np.random.default_rng()
+    n = len(members)
+    sizes = group_sizes(n, group_size)
+    if len(sizes) < 2:
+        return [list(members)] if members else []
+    full = sizes.count(group_size)
+    batch = max(MAX_BATCH_ELEMENTS // n, 1)
+    best_perm, best_score = None, None
+    remaining = candidates
+    while remaining > 0:
+        k = min(batch, remaining)
+        remaining -= k
+        perms = rng.permuted(np.tile(np.arange(n, dtype=np.int32), (k, 1)), axis=1)
+        scores = _score(perms, full, group_size, matrix)
+        i = int(np.argmin(scores))
+        if best_score is None or scores[i] < best_score:
+            best_perm, best_score = perms[i], scores[i]
+            if best_score == 0:
+                break
+    groups: List[List[int]] = []
+    start = 0
+    for size in sizes:
+        groups.append([members[m] for m in best_perm[start:start + size]])
+        start += size
+    return groups
+
+def _score(perms: "np.ndarray", full: int, group_size: int, matrix: "np.ndarray") -> "np.ndarray":
+    blocks = perms[:, :full * group_size].reshape(len(perms), full, group_size)
+    # The leftover columns are one odd-sized group
+    tail = perms[:, full * group_size:]
+    scores = np.zeros(len(perms), dtype=np.int64)
+    for i in range(group_size):
+        for j in range(i + 1, group_size):
+            scores += matrix[blocks[:, :, i], blocks[:, :, j]].sum(axis=1)
+    for i in range(tail.shape[1]):
+        for j in range(i + 1, tail.shape[1]):
+            scores += matrix[tail[:, i], tail[:, j]]
+    return scores
@@ -0,0 +1,43 @@
+import unittest
+
+from donutbot.grouping import RepairedGroup, repair_groups
+
+def no_cost(a: int, b: int) -> int:
+    return 0
+
+class RepairGroupsTest(unittest.TestCase):
+    def test_unchanged_round_is_kept(self) -> None:
+        repaired = repair_groups([[0, 1, 2], [3, 4, 5]], range(6), 3, no_cost)
+        self.assertEqual(repaired, [RepairedGroup([0, 1, 2], 0), RepairedGroup([3, 4, 5], 1)])
+
+    def test_leavers_are_dropped(self) -> None:
+        repaired = repair_groups([[0, 1, 2], [3, 4, 5]], [0, 1, 3, 4, 5], 3, no_cost)
+        self.assertEqual(repaired, [RepairedGroup([0, 1], 0), RepairedGroup([3, 4, 5], 1)])
+
+    def test_newcomers_make_full_groups(self) -> None:
+        repaired = repair_groups([[0, 1, 2]], [0, 1, 2, 7, 8, 9], 3, no_cost)
+        self.assertEqual(repaired, [RepairedGroup([0, 1, 2], 0), RepairedGroup([7, 8, 9], None)])
+
+    def test_big_remainder_becomes_its_own_group(self) -> None:
+        # 1 and 2 leave, so 0 is alone and joins newcomer 9: two is more than half a group
+        repaired = repair_groups([[0, 1, 2], [3, 4, 5]], [0, 3, 4, 5, 9], 3, no_cost)
+        self.assertEqual(repaired, [RepairedGroup([3, 4, 5], 1), RepairedGroup([9, 0], None)])
+
+    def test_small_remainder_joins_smallest_group(self) -> None:
+        repaired = repair_groups([[0, 1, 2], [3, 4]], [0, 1, 2, 3, 4, 9], 3, no_cost)
+        self.assertEqual(repaired, [RepairedGroup([0, 1, 2], 0), RepairedGroup([3, 4, 9], 1)])
+
+    def test_small_remainder_avoids_people_met_before(self) -> None:
+        def cost(a: int, b: int) -> int:
+            return 1 if {a, b} == {9, 0} else 0
+        repaired = repair_groups([[0, 1], [2, 3]], [0, 1, 2, 3, 9], 2, cost)
+        self.assertEqual(repaired, [RepairedGroup([0, 1], 0), RepairedGroup([2, 3, 9], 1)])
+
+    def test_everyone_gone(self) -> None:
+        self.assertEqual(repair_groups([[0, 1], [2, 3]], [], 2, no_cost), [])
+
+    def test_single_member_left(self) -> None:
+        self.assertEqual(repair_groups([[0, 1]], [0], 2, no_cost), [RepairedGroup([0], None)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from mautrix.types import Member, Membership, UserID
+from mautrix.util.async_db import Database
+
+from benchmarks.core import make_members
+from benchmarks.e2e import CONFIG_OVERRIDES, BenchmarkBot, load_config
+from benchmarks.fake_client import FakeClient, FakeMessageEvent
+from donutbot import db
+
+class RepairJournalTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = Database.create(f"sqlite:///{os.path.join(self.tmp.name, 'donutbot.db')}",
+                                        upgrade_table=db.upgrade_table)
+        await self.database.start()
+        self.client = FakeClient()
+        self.room = self.client.add_room({m.mxid: m.display_name for m in make_members(12)})
+        self.bot = BenchmarkBot(self.client, self.database, load_config(CONFIG_OVERRIDES))
+        await self.bot.start()
+        await self.command("!donut new 3")
+        await self.command("!donut confirm")
+
+    async def asyncTearDown(self) -> None:
+        await self.bot.stop()
+        await self.database.stop()
+        self.tmp.cleanup()
+
+    async def command(self, body: str) -> str:
+        evt = FakeMessageEvent(self.client, self.room, body)
+        await self.bot.base_command(evt)
+        return evt.responses[-1]["body"]
+
+    async def join(self, count: int) -> None:
+        for i in range(count):
+            self.client.members[self.room][UserID(f"@new{i}:example.org")] = Member(
+                membership=Membership.JOIN, displayname=f"New {i}")
+        await self.bot.load_roster(self.room)
+
+    async def test_retry_only_sets_up_unfinished_groups(self) -> None:
+        # Three newcomers make a group of their own, the fourth joins an existing one
+        await self.join(4)
+        self.client.failure_rates = {"create_room": 1.0}
+        self.assertIn("1 of 2 changed DONUT groups could not be set up", await self.command("!donut repair"))
+        journal = await db.get_setup(self.database, self.room)
+        self.assertEqual([s.step for s in journal.values()], [db.SETUP_WELCOMED])
+        self.assertTrue(all(key.startswith(db.REPAIR_PREFIX) for key in journal))
+
+        self.client.failure_rates = {}
+        self.client.reset_stats()
+        self.assertIn("DONUT repaired for 4 new and 0 departed members", await self.command("!donut repair"))
+        # The group that joined an existing room was done already
+        self.assertEqual(self.client.calls["create_room"], 1)
+        self.assertEqual(self.client.calls["invite_user"], 0)
+        self.assertEqual(self.client.calls["get_joined_members"], 0)
+        self.assertEqual(await db.get_setup(self.database, self.room), {})
+        current = await self.bot.get_current_donut(self.room)
+        self.assertEqual(sum(len(group) for group in current), 16)
+
+    async def test_journal_outlives_proposals(self) -> None:
+        await db.record_setup(self.database, self.room, db.REPAIR_PREFIX + "a", db.SETUP_CREATED, "!a:x")
+        await db.record_setup(self.database, self.room, "b", db.SETUP_CREATED, "!b:x")
+        await db.put_proposal(self.database, self.room, "[]", 0)
+        self.assertEqual(set(await db.get_setup(self.database, self.room)), {db.REPAIR_PREFIX + "a"})
+        await db.delete_proposal(self.database, self.room)
+        self.assertEqual(set(await db.get_setup(self.database, self.room)), {db.REPAIR_PREFIX + "a"})
+        await db.delete_repair_setup(self.database, self.room)
+        self.assertEqual(await db.get_setup(self.database, self.room), {})
+
+    async def test_new_round_drops_unfinished_repair(self) -> None:
+        await self.join(4)
+        self.client.failure_rates = {"create_room": 1.0}
+        await self.command("!donut repair")
+        self.client.failure_rates = {}
+        await self.command("!donut new 3")
+        await self.command("!donut confirm")
+        self.assertEqual(await db.get_setup(self.database, self.room), {})
+
+if __name__ == "__main__":
+    unittest.main()